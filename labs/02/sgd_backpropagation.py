@@ -10,11 +10,13 @@ import numpy as np
 import torch
 import torch.utils.tensorboard
 
+from compiled_step import CompiledStep
 from mnist import MNIST
 
 parser = argparse.ArgumentParser()
 # These arguments will be set appropriately by ReCodEx, even if you change them.
 parser.add_argument("--batch_size", default=64, type=int, help="Batch size.")
+parser.add_argument("--compile", default=False, action="store_true", help="Compile the training step.")
 parser.add_argument("--epochs", default=10, type=int, help="Number of epochs.")
 parser.add_argument("--hidden_layer", default=20, type=int, help="Size of the hidden layer.")
 parser.add_argument("--learning_rate", default=0.1, type=float, help="Learning rate.")
@@ -47,6 +49,8 @@ class Model(keras.Model):
         )
         self._b2 = keras.Variable(keras.ops.zeros([MNIST.LABELS]), trainable=True)
 
+        self.compiled_train_step = CompiledStep(self.sgd_step, getattr(args, "compile", False))
+
     def predict(self, inputs: torch.Tensor) -> torch.Tensor:
         # TODO: Define the computation of the network. Notably:
         # - start by casting the input byte image to `float32` with `keras.ops.cast`
@@ -66,46 +70,50 @@ class Model(keras.Model):
         return keras.ops.softmax(inputs)
 
     def train_epoch(self, dataset: MNIST.Dataset) -> None:
-        for batch in dataset.batches(self._args.batch_size):
+        last_batch = "drop" if self.compiled_train_step.compiled else "keep"
+        for batch in dataset.batches(self._args.batch_size, last_batch):
             # The batch contains
             # - batch["images"] with shape [?, MNIST.H, MNIST.W, MNIST.C]
             # - batch["labels"] with shape [?]
             # Size of the batch is `self._args.batch_size`, except for the last, which
-            # might be smaller.
-
-            # TODO: Compute the predicted probabilities of the batch images using `self.predict`
-            probabilities = self.predict(batch["images"])
-
-            # TODO: Manually compute the loss:
-            # - For every batch example, the loss is the categorical crossentropy of the
-            #   predicted probabilities and the gold label. To compute the crossentropy, you can
-            #   - either use `keras.ops.one_hot` to obtain one-hot encoded gold labels,
-            #   - or suitably use `keras.ops.take_along_axis` to "index" the predicted probabilities.
-            # - Finally, compute the average across the batch examples.
-            #loss = keras.ops.reduce_mean(keras.ops.sparse_categorical_crossentropy(batch["labels"], probabilities))
-            loss = torch.mean(keras.ops.sparse_categorical_crossentropy(batch["labels"], probabilities))
-
-            # We create a list of all variables. Note that a `keras.Model/Layer` automatically
-            # tracks owned variables, so we could also use `self.trainable_variables`
-            # (or even `self.variables`, which is useful for loading/saving).
-            variables = [self._W1, self._b1, self._W2, self._b2]
-
-            # TODO: Compute the gradient of the loss with respect to variables using
-            # backpropagation algorithm by
-            # - first resetting the gradients of all variables to zero with `self.zero_grad()`,
-            # - then calling `loss.backward()`.
-            with torch.autograd.detect_anomaly():
-                self.zero_grad() # reset gradientov
-                loss.backward()
-
-            gradients = [variable.value.grad for variable in variables]
-            with torch.no_grad():
-                for variable, gradient in zip(variables, gradients):
-                    # TODO: Perform the SGD update with learning rate `self._args.learning_rate`
-                    # for the variable and computed gradient. You can modify the
-                    # variable value with `variable.assign` or in this case the more
-                    # efficient `variable.assign_sub`.
-                    variable.assign_sub(self._args.learning_rate * gradient)
+            # might be smaller; when compiling, it is dropped, so that the shapes do not change.
+            self.compiled_train_step(torch.as_tensor(batch["images"]), torch.as_tensor(batch["labels"]))
+
+    # A single SGD step, which can be compiled by `CompiledStep` with `--compile`.
+    def sgd_step(self, images: torch.Tensor, labels: torch.Tensor) -> None:
+        # TODO: Compute the predicted probabilities of the batch images using `self.predict`
+        probabilities = self.predict(images)
+
+        # TODO: Manually compute the loss:
+        # - For every batch example, the loss is the categorical crossentropy of the
+        #   predicted probabilities and the gold label. To compute the crossentropy, you can
+        #   - either use `keras.ops.one_hot` to obtain one-hot encoded gold labels,
+        #   - or suitably use `keras.ops.take_along_axis` to "index" the predicted probabilities.
+        # - Finally, compute the average across the batch examples.
+        #loss = keras.ops.reduce_mean(keras.ops.sparse_categorical_crossentropy(labels, probabilities))
+        loss = torch.mean(keras.ops.sparse_categorical_crossentropy(labels, probabilities))
+
+        # We create a list of all variables. Note that a `keras.Model/Layer` automatically
+        # tracks owned variables, so we could also use `self.trainable_variables`
+        # (or even `self.variables`, which is useful for loading/saving).
+        variables = [self._W1, self._b1, self._W2, self._b2]
+
+        # TODO: Compute the gradient of the loss with respect to variables using
+        # backpropagation algorithm by
+        # - first resetting the gradients of all variables to zero with `self.zero_grad()`,
+        # - then calling `loss.backward()`.
+        with torch.autograd.set_detect_anomaly(getattr(self._args, "detect_anomaly", True)):
+            self.zero_grad() # reset gradientov
+            loss.backward()
+
+        gradients = [variable.value.grad for variable in variables]
+        with torch.no_grad():
+            for variable, gradient in zip(variables, gradients):
+                # TODO: Perform the SGD update with learning rate `self._args.learning_rate`
+                # for the variable and computed gradient. You can modify the
+                # variable value with `variable.assign` or in this case the more
+                # efficient `variable.assign_sub`.
+                variable.assign_sub(self._args.learning_rate * gradient)
 
     def evaluate(self, dataset: MNIST.Dataset) -> float:
         # Compute the accuracy of the model prediction
@@ -159,6 +167,9 @@ def main(args: argparse.Namespace) -> tuple[float, float]:
     print("Test accuracy after epoch {} is {:.2f}".format(epoch + 1, 100 * test_accuracy), flush=True)
     writer.add_scalar("test/accuracy", 100 * test_accuracy, epoch + 1)
 
+    if args.compile:
+        print(model.compiled_train_step.report(), flush=True)
+
     # Return dev and test accuracies for ReCodEx to validate.
     return accuracy, test_accuracy
 
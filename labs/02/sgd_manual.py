@@ -3,6 +3,7 @@ import argparse
 import datetime
 import os
 import re
+import time
 os.environ.setdefault("KERAS_BACKEND", "torch")  # Use PyTorch backend unless specified otherwise
 
 import keras
@@ -10,11 +11,14 @@ import numpy as np
 import torch
 import torch.utils.tensorboard
 
+from compiled_step import CompiledStep
 from mnist import MNIST
 
 parser = argparse.ArgumentParser()
 # These arguments will be set appropriately by ReCodEx, even if you change them.
 parser.add_argument("--batch_size", default=64, type=int, help="Batch size.")
+parser.add_argument("--benchmark", default=0, type=int, help="Benchmark this many steps against autograd.")
+parser.add_argument("--compile", default=False, action="store_true", help="Compile the training step.")
 parser.add_argument("--epochs", default=10, type=int, help="Number of epochs.")
 parser.add_argument("--hidden_layer", default=20, type=int, help="Size of the hidden layer.")
 parser.add_argument("--learning_rate", default=0.1, type=float, help="Learning rate.")
@@ -24,6 +28,68 @@ parser.add_argument("--threads", default=1, type=int, help="Maximum number of th
 # If you add more arguments, ReCodEx will keep them with your default values.
 
 
+# A multilayer perceptron with tanh or ReLU hidden layers and a softmax output layer, trained
+# by SGD with manually computed gradients. The `variables` are the weights and biases of the
+# layers, `[W1, b1, W2, b2, ...]`. All activations and gradients are kept in buffers preallocated
+# for `batch_size` examples (smaller batches use their leading rows), so a training step performs
+# no allocations: the matrix products use `out=`, the activations and their derivatives are computed
+# in place, and the gradient of the softmax with crossentropy is computed directly from the logits.
+class ManualMLP:
+    def __init__(self, variables: list[keras.Variable], activation: str, batch_size: int) -> None:
+        if activation not in ["tanh", "relu"]:
+            raise ValueError("Unknown activation '{}'.".format(activation))
+        self._activation, self._batch_size = activation, batch_size
+        self._parameters = [variable.value for variable in variables]
+        self._weights, self._biases = self._parameters[0::2], self._parameters[1::2]
+
+        self._inputs = torch.empty(batch_size, self._weights[0].shape[0])
+        self._outputs = [torch.empty(batch_size, weights.shape[1]) for weights in self._weights]
+        self._deltas = [torch.empty(batch_size, weights.shape[1]) for weights in self._weights]
+        self._gradients = [torch.empty_like(parameter) for parameter in self._parameters]
+        self._labels = torch.empty(batch_size, 1, dtype=torch.int64)
+        self._minus_ones = torch.full([batch_size, 1], -1.)
+
+    @torch.no_grad()
+    def train_step(
+        self, images: np.ndarray | torch.Tensor, labels: np.ndarray | torch.Tensor, learning_rate: float,
+    ) -> None:
+        size = len(images)
+        if size > self._batch_size:
+            raise ValueError("The batch size {} exceeds the preallocated {}.".format(size, self._batch_size))
+
+        # Forward pass, keeping the outputs of all layers.
+        inputs = torch.div(torch.as_tensor(images).reshape(size, -1), 255, out=self._inputs[:size])
+        layer_inputs = [inputs] + [outputs[:size] for outputs in self._outputs[:-1]]
+        for layer, (weights, biases) in enumerate(zip(self._weights, self._biases)):
+            outputs = torch.addmm(biases, layer_inputs[layer], weights, out=self._outputs[layer][:size])
+            if layer + 1 < len(self._weights) and self._activation == "tanh":
+                outputs.tanh_()
+            elif layer + 1 < len(self._weights):
+                outputs.relu_()
+
+        # The gradient of the mean crossentropy with respect to the logits is `(softmax - one_hot) / size`.
+        delta = self._deltas[-1][:size]
+        torch.sub(outputs, outputs.amax(dim=1, keepdim=True), out=delta).exp_()
+        delta.div_(delta.sum(dim=1, keepdim=True))
+        self._labels[:size, 0].copy_(torch.as_tensor(labels))
+        delta.scatter_add_(1, self._labels[:size], self._minus_ones[:size]).div_(size)
+
+        # Backward pass; the derivative of an activation is computed in place of its outputs.
+        for layer in reversed(range(len(self._weights))):
+            torch.mm(layer_inputs[layer].T, delta, out=self._gradients[2 * layer])
+            torch.sum(delta, dim=0, out=self._gradients[2 * layer + 1])
+            if layer:
+                previous_delta = torch.mm(delta, self._weights[layer].T, out=self._deltas[layer - 1][:size])
+                if self._activation == "tanh":
+                    previous_delta.mul_(layer_inputs[layer].square_().neg_().add_(1))
+                else:
+                    previous_delta.mul_(layer_inputs[layer].sign_())
+                delta = previous_delta
+
+        for parameter, gradient in zip(self._parameters, self._gradients):
+            parameter.add_(gradient, alpha=-learning_rate)
+
+
 class Model(keras.Model):
     def __init__(self, args: argparse.Namespace) -> None:
         super().__init__()
@@ -45,6 +111,9 @@ class Model(keras.Model):
         )
         self._b2 = keras.Variable(keras.ops.zeros([MNIST.LABELS]), trainable=True)
 
+        self._engine = ManualMLP([self._W1, self._b1, self._W2, self._b2], "tanh", args.batch_size)
+        self.compiled_train_step = CompiledStep(self._engine.train_step, getattr(args, "compile", False))
+
     def predict(self, inputs: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         # TODO(sgd_backpropagation): Define the computation of the network. Notably:
         # - start by casting the input byte image to `float32` with `keras.ops.cast`
@@ -69,12 +138,13 @@ class Model(keras.Model):
         return output, hidden, inputs
 
     def train_epoch(self, dataset: MNIST.Dataset) -> None:
-        for batch in dataset.batches(self._args.batch_size):
+        last_batch = "drop" if self.compiled_train_step.compiled else "keep"
+        for batch in dataset.batches(self._args.batch_size, last_batch):
             # The batch contains
             # - batch["images"] with shape [?, MNIST.H, MNIST.W, MNIST.C]
             # - batch["labels"] with shape [?]
             # Size of the batch is `self._args.batch_size`, except for the last, which
-            # might be smaller.
+            # might be smaller; when compiling, it is dropped, so that the shapes do not change.
 
             # TODO: Contrary to `sgd_backpropagation`, the goal here is to compute
             # the gradient manually, without calling `.backward()`. ReCodEx disables
@@ -103,23 +173,10 @@ class Model(keras.Model):
             # for the variable and computed gradient. You can modify the
             # variable value with `variable.assign` or in this case the more
             # efficient `variable.assign_sub`.
-            output, hidden, inputs = self.predict(batch["images"])
-
-            # Compute the gradient of the loss with respect to all variables.
-            dLdoutput = output - keras.ops.one_hot(batch["labels"], MNIST.LABELS)
-            dLdW2 = keras.ops.matmul(keras.ops.transpose(hidden), dLdoutput) / batch["images"].shape[0]
-            dLdb2 = torch.mean(dLdoutput, dim=0)
-            dLdh = keras.ops.matmul(dLdoutput, keras.ops.transpose(self._W2))
-            dLdhidden = dLdh * (1 - keras.ops.square(hidden))
-            dLdW1 = keras.ops.matmul(keras.ops.transpose(inputs), dLdhidden) / batch["images"].shape[0]
-            dLdb1 = torch.mean(dLdhidden, dim=0)
-
-            # Perform the SGD update with learning rate `self._args.learning_rate`
-            self._W1.assign_sub(self._args.learning_rate * dLdW1)
-            self._b1.assign_sub(self._args.learning_rate * dLdb1)
-            self._W2.assign_sub(self._args.learning_rate * dLdW2)
-            self._b2.assign_sub(self._args.learning_rate * dLdb2)
-
+            # The forward pass, the gradient computation and the SGD update are performed
+            # by the `ManualMLP` engine, using its preallocated buffers.
+            self.compiled_train_step(
+                torch.as_tensor(batch["images"]), torch.as_tensor(batch["labels"]), self._args.learning_rate)
 
     def evaluate(self, dataset: MNIST.Dataset) -> float:
         # Compute the accuracy of the model prediction
@@ -137,6 +194,25 @@ class Model(keras.Model):
         return correct / dataset.size
 
 
+# Compare the training steps per second of the manual gradient computation
+# and of the automatic differentiation in `sgd_backpropagation`, with its
+# anomaly detection disabled, so that only the gradient computation is compared.
+def benchmark(args: argparse.Namespace, mnist: MNIST) -> None:
+    import sgd_backpropagation
+
+    size = min(args.benchmark * args.batch_size, mnist.train.size)
+    dataset = MNIST.Dataset({key: value[:size] for key, value in mnist.train.data.items()}, shuffle_batches=False)
+    steps = -(-size // args.batch_size)
+    autograd_args = argparse.Namespace(**vars(args) | {"detect_anomaly": False})
+    for name, model in [("autograd", sgd_backpropagation.Model(autograd_args)), ("manual", Model(args))]:
+        model.train_epoch(dataset)  # Warm-up
+        start = time.perf_counter()
+        model.train_epoch(dataset)
+        duration = time.perf_counter() - start
+        print("{}: {:.1f} steps/s, dev accuracy {:.2f}".format(
+            name, steps / duration, 100 * model.evaluate(mnist.dev)), flush=True)
+
+
 def main(args: argparse.Namespace) -> tuple[float, float]:
     # Set the random seed and the number of threads.
     keras.utils.set_random_seed(args.seed)
@@ -154,6 +230,9 @@ def main(args: argparse.Namespace) -> tuple[float, float]:
     # Load data
     mnist = MNIST()
 
+    if args.benchmark:
+        return benchmark(args, mnist)
+
     # Create the TensorBoard writer
     writer = torch.utils.tensorboard.SummaryWriter(args.logdir)
 
@@ -174,6 +253,9 @@ def main(args: argparse.Namespace) -> tuple[float, float]:
     print("Test accuracy after epoch {} is {:.2f}".format(epoch + 1, 100 * test_accuracy), flush=True)
     writer.add_scalar("test/accuracy", 100 * test_accuracy, epoch + 1)
 
+    if args.compile:
+        print(model.compiled_train_step.report(), flush=True)
+
     # Return dev and test accuracies for ReCodEx to validate.
     return accuracy, test_accuracy
 
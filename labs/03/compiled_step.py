@@ -0,0 +1,59 @@
+import statistics
+import time
+from typing import Any, Callable
+import warnings
+
+import torch
+
+
+# Wraps a training step, optionally compiled with `torch.compile`. The first `eager_steps` steps
+# are always run in eager mode, to measure the eager step duration; the following step triggers
+# the compilation, and all later steps run compiled. If the compilation fails (for example when
+# no C++ compiler is available), a warning is issued and the step keeps running in eager mode.
+#
+# The step durations are recorded, and `report()` describes the compilation time, the eager and
+# the compiled step durations (medians, so that occasional recompilations for a different batch
+# size do not distort them), and the number of steps after which the compilation pays off.
+class CompiledStep:
+    def __init__(self, step: Callable[..., Any], compile: bool = True, eager_steps: int = 10, **kwargs) -> None:
+        self._eager_step = step
+        self._compiled_step = torch.compile(step, **kwargs) if compile else None
+        self._eager_steps = eager_steps
+        self._durations = {"eager": [], "compilation": [], "compiled": []}
+
+    @property
+    def compiled(self) -> bool:
+        return self._compiled_step is not None
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        kind = "eager"
+        if self.compiled and len(self._durations["eager"]) >= self._eager_steps:
+            kind = "compiled" if self._durations["compilation"] else "compilation"
+
+        start = time.perf_counter()
+        if kind == "eager":
+            result = self._eager_step(*args, **kwargs)
+        else:
+            try:
+                result = self._compiled_step(*args, **kwargs)
+            except Exception as error:
+                if kind != "compilation":
+                    raise
+                warnings.warn("The compilation failed, running in eager mode: {}".format(error))
+                self._compiled_step, kind = None, "eager"
+                start = time.perf_counter()
+                result = self._eager_step(*args, **kwargs)
+        self._durations[kind].append(time.perf_counter() - start)
+        return result
+
+    def report(self) -> str:
+        eager = statistics.median(self._durations["eager"][1:] or self._durations["eager"] or [float("nan")])
+        if not self._durations["compiled"]:
+            return "Eager step {:.3f}ms{}".format(1000 * eager, ", not compiled" if not self.compiled else "")
+
+        compiled = statistics.median(self._durations["compiled"])
+        compilation = self._durations["compilation"][0]
+        return "Eager step {:.3f}ms, compilation {:.2f}s, compiled step {:.3f}ms, speedup {:.2f}x, {}".format(
+            1000 * eager, compilation, 1000 * compiled, eager / compiled,
+            "pays off after {:.0f} steps".format(compilation / (eager - compiled)) if compiled < eager
+            else "never pays off")
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import time
 os.environ.setdefault("KERAS_BACKEND", "torch")  # Use PyTorch backend unless specified otherwise
 
 import keras
+import numpy as np
 import torch
 
 from mnist import MNIST
@@ -14,9 +16,23 @@ parser.add_argument("--batch_size", default=50, type=int, help="Batch size.")
 parser.add_argument("--epochs", default=10, type=int, help="Number of epochs.")
 parser.add_argument("--hidden_layers", default=[100], nargs="*", type=int, help="Hidden layer sizes.")
 parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+parser.add_argument("--steps_per_execution", default=1, type=int, help="Steps performed in a single call.")
 parser.add_argument("--threads", default=1, type=int, help="Maximum number of threads to use.")
 
 
+# Perform a training step (or a test step when `training=False`) on every `batch_size` examples of the
+# given `batches`, all in a single call. This emulates `steps_per_execution`, which the PyTorch backend
+# does not support: unlike calling `train_on_batch` for every batch, the per-call bookkeeping is done
+# only once, and the metrics are converted to Python values only after the last step. As with
+# `train_on_batch`, the metrics are not reset, so they accumulate until `model.reset_metrics()`.
+def run_steps(model: keras.Model, batches: dict[str, np.ndarray], batch_size: int, training: bool) -> dict[str, float]:
+    step = model.train_step if training else model.test_step
+    images, labels = torch.as_tensor(batches["images"]), torch.as_tensor(batches["labels"])
+    for batch_images, batch_labels in zip(images.split(batch_size), labels.split(batch_size)):
+        logs = step((batch_images, batch_labels, None))
+    return {name: float(value) for name, value in sorted(logs.items())}
+
+
 def main(args: argparse.Namespace) -> None:
     # Set the random seed and the number of threads.
     keras.utils.set_random_seed(args.seed)
@@ -43,19 +59,35 @@ def main(args: argparse.Namespace) -> None:
         metrics=[keras.metrics.SparseCategoricalAccuracy("accuracy")],
     )
 
+    # With `--steps_per_execution` larger than one, the batches are generated `steps_per_execution` times
+    # larger and every one is processed by a single `run_steps` call.
+    execution_size = args.batch_size * args.steps_per_execution
+
     for epoch in range(args.epochs):
+        start = time.perf_counter()
         model.reset_metrics()
-        for batch in mnist.train.batches(args.batch_size):
-            train = model.train_on_batch(batch["images"], batch["labels"], return_dict=True)
+        for batch in mnist.train.batches(execution_size):
+            if args.steps_per_execution > 1:
+                train = run_steps(model, batch, args.batch_size, training=True)
+            else:
+                train = model.train_on_batch(batch["images"], batch["labels"], return_dict=True)
+        throughput = mnist.train.size / (time.perf_counter() - start)
 
         model.reset_metrics()
-        for batch in mnist.dev.batches(args.batch_size):
-            dev = model.test_on_batch(batch["images"], batch["labels"], return_dict=True)
-        print("Epoch {} finished.\n  Train: {}\n  Dev: {}".format(epoch + 1, train, dev))
+        for batch in mnist.dev.batches(execution_size):
+            if args.steps_per_execution > 1:
+                dev = run_steps(model, batch, args.batch_size, training=False)
+            else:
+                dev = model.test_on_batch(batch["images"], batch["labels"], return_dict=True)
+        print("Epoch {} finished, {:.0f} train examples/s.\n  Train: {}\n  Dev: {}".format(
+            epoch + 1, throughput, train, dev))
 
     model.reset_metrics()
-    for batch in mnist.test.batches(args.batch_size):
-        test = model.test_on_batch(batch["images"], batch["labels"], return_dict=True)
+    for batch in mnist.test.batches(execution_size):
+        if args.steps_per_execution > 1:
+            test = run_steps(model, batch, args.batch_size, training=False)
+        else:
+            test = model.test_on_batch(batch["images"], batch["labels"], return_dict=True)
     print("Test: {}".format(test))
 
 
@@ -6,11 +6,13 @@ os.environ.setdefault("KERAS_BACKEND", "torch")  # Use PyTorch backend unless sp
 import keras
 import torch
 
+from compiled_step import CompiledStep
 from mnist import MNIST
 
 # Parse arguments
 parser = argparse.ArgumentParser()
 parser.add_argument("--batch_size", default=50, type=int, help="Batch size.")
+parser.add_argument("--compile", default=False, action="store_true", help="Compile the training step.")
 parser.add_argument("--epochs", default=10, type=int, help="Number of epochs.")
 parser.add_argument("--hidden_layers", default=[100], nargs="*", type=int, help="Hidden layer sizes.")
 parser.add_argument("--seed", default=42, type=int, help="Random seed.")
@@ -41,17 +43,22 @@ def main(args: argparse.Namespace) -> None:
     loss_fn = keras.losses.SparseCategoricalCrossentropy()
     accuracy = keras.metrics.SparseCategoricalAccuracy()
 
+    def train_step(images: torch.Tensor, labels: torch.Tensor) -> None:
+        probabilities = model(images, training=True)
+        loss = loss_fn(labels, probabilities)
+        accuracy(labels, probabilities)
+
+        model.zero_grad()
+        loss.backward()
+        with torch.no_grad():
+            optimizer.apply([v.value.grad for v in model.trainable_variables], model.trainable_variables)
+    train_step = CompiledStep(train_step, args.compile)
+
     for epoch in range(args.epochs):
         accuracy.reset_state()
-        for batch in mnist.train.batches(args.batch_size):
-            probabilities = model(batch["images"], training=True)
-            loss = loss_fn(batch["labels"], probabilities)
-            accuracy(batch["labels"], probabilities)
-
-            model.zero_grad()
-            loss.backward()
-            with torch.no_grad():
-                optimizer.apply([v.value.grad for v in model.trainable_variables], model.trainable_variables)
+        # When compiling, the incomplete last batch is dropped, so that the shapes do not change.
+        for batch in mnist.train.batches(args.batch_size, "drop" if train_step.compiled else "keep"):
+            train_step(torch.as_tensor(batch["images"]), torch.as_tensor(batch["labels"]))
         train = accuracy.result()
 
         accuracy.reset_state()
@@ -68,6 +75,9 @@ def main(args: argparse.Namespace) -> None:
     test = accuracy.result()
     print("Test: {}".format(test))
 
+    if args.compile:
+        print(train_step.report())
+
 
 if __name__ == "__main__":
     args = parser.parse_args([] if "__file__" not in globals() else None)
@@ -16,10 +16,12 @@ from uppercase_data import UppercaseData
 parser = argparse.ArgumentParser()
 parser.add_argument("--alphabet_size", default=..., type=int, help="If given, use this many most frequent chars.")
 parser.add_argument("--batch_size", default=..., type=int, help="Batch size.")
+parser.add_argument("--cache_dir", default=None, type=str, help="Directory to cache the preprocessed data in.")
 parser.add_argument("--epochs", default=..., type=int, help="Number of epochs.")
 parser.add_argument("--seed", default=42, type=int, help="Random seed.")
 parser.add_argument("--threads", default=1, type=int, help="Maximum number of threads to use.")
 parser.add_argument("--window", default=..., type=int, help="Window size to use.")
+parser.add_argument("--workers", default=1, type=int, help="Processes preprocessing large data (0 = all cores).")
 
 
 class TorchTensorBoardCallback(keras.callbacks.Callback):
@@ -62,7 +64,7 @@ def main(args: argparse.Namespace) -> None:
     ))
 
     # Load data
-    uppercase_data = UppercaseData(args.window, args.alphabet_size)
+    uppercase_data = UppercaseData(args.window, args.alphabet_size, cache_dir=args.cache_dir, workers=args.workers)
 
     # TODO: Implement a suitable model, optionally including regularization, select
     # good hyperparameters and train the model.
@@ -84,7 +86,9 @@ def main(args: argparse.Namespace) -> None:
     # TODO: Generate correctly capitalized test set.
     # Use `uppercase_data.test.text` as input, capitalize suitable characters,
     # and write the result to predictions_file (which is
-    # `uppercase_test.txt` in the `args.logdir` directory).
+    # `uppercase_test.txt` in the `args.logdir` directory). Given 0/1 predictions
+    # for all test characters, `uppercase_data.test.recase(predictions)` returns
+    # the capitalized text.
     os.makedirs(args.logdir, exist_ok=True)
     with open(os.path.join(args.logdir, "uppercase_test.txt"), "w", encoding="utf-8") as predictions_file:
         ...
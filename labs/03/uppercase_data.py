@@ -1,6 +1,13 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import shutil
 import sys
-from typing import TextIO
+from typing import Any, Callable, Iterator, TextIO
 import urllib.request
 import zipfile
 
@@ -23,14 +30,29 @@ import numpy as np
 #   - `size`: the length of the text
 #   - `data`: a dictionary with keys
 #       - "windows": input examples with shape `[size, 2 * window_size + 1]`,
-#            corresponding to indices of input lowercased characters
+#            corresponding to indices of input lowercased characters; it is
+#            a read-only view (not a copy), so batches should be created
+#            by indexing it, and `np.array` should be used to get a copy
 #       - "labels": input labels with shape `[size]`, each a 0/1 value whether
 #            the corresponding input in `windows` is lowercased/uppercased
 #   - `text`: the original text (of course lowercased in case of the test set)
 #   - `alphabet`: an alphabet used by `windows`
+#   - `segments(segment_length, context)`: the text split into contiguous
+#       segments with per-character labels, an alternative to `windows`
+#   - `recase(predictions)`: the text cased according to 0/1 predictions
+# - If `cache_dir` is given, the preprocessed datasets are stored there and
+#   loaded memory-mapped by later runs with the same data, `window` and `alphabet_size`.
+# - For texts too large to fit in memory, `UppercaseData.stream` yields batches
+#   of windows and labels of a text file read in chunks.
 class UppercaseData:
     LABELS: int = 2
 
+    # The size in bytes of all texts from which preprocessing them in worker processes pays off. Starting
+    # the pool takes ~0.5s, and the decompression and decoding in the main process stay sequential, so
+    # on four cores the pool is faster only from ~30MB of text. When the main script imports Keras, every
+    # worker spends further seconds importing it again, and the pool pays off only from hundreds of MB.
+    _PARALLEL_MIN_SIZE: int = 32 << 20
+
     _URL: str = "https://ufal.mff.cuni.cz/~straka/courses/npfl138/2324/datasets/uppercase_data.zip"
 
     class Dataset:
@@ -53,37 +75,77 @@ class UppercaseData:
                         raise ValueError("UppercaseData: Duplicated character '{}' in the alphabet.".format(letter))
                     alphabet_map[letter] = index
             else:
-                # Find most frequent characters
-                freqs = {}
-                for char in self._text.lower():
-                    freqs[char] = freqs.get(char, 0) + 1
-
-                most_frequent = sorted(freqs.items(), key=lambda item: item[1], reverse=True)
-                for i, (char, freq) in enumerate(most_frequent, len(alphabet_map)):
-                    alphabet_map[char] = i
-                    if alphabet and len(alphabet_map) >= alphabet:
-                        break
+                # Find most frequent characters, with ties broken by the first occurrence
+                chars, freqs, firsts, _ = UppercaseData._count_chars(self._text)
+                for letter in UppercaseData._most_frequent(chars, freqs, firsts, alphabet):
+                    alphabet_map[letter] = len(alphabet_map)
 
             # Remap lowercased input characters using the alphabet_map
+            codes = UppercaseData._code_points(self._text)
             lcletters = np.zeros(self._size + 2 * window, np.int16)
-            for i in range(self._size):
-                char = self._text[i].lower()
-                if char not in alphabet_map:
-                    char = "<unk>"
-                lcletters[i + window] = alphabet_map[char]
-
-            # Generate input batches
-            windows = np.zeros([self._size, 2 * window + 1], np.int16)
-            labels = np.zeros(self._size, np.uint8)
-            for i in range(self._size):
-                windows[i] = lcletters[i:i + 2 * window + 1]
-                labels[i] = self._text[i].isupper()
-            self._data = {"windows": windows, "labels": labels}
+            lcletters[window:window + self._size] = UppercaseData._lookup_table(
+                codes, lambda char: alphabet_map.get(char.lower(), alphabet_map["<unk>"]), np.int16)[codes]
+
+            labels = UppercaseData._lookup_table(codes, str.isupper, np.uint8)[codes]
 
             # Compute alphabet
-            self._alphabet = [None] * len(alphabet_map)
+            alphabet = [None] * len(alphabet_map)
             for key, value in alphabet_map.items():
-                self._alphabet[value] = key
+                alphabet[value] = key
+
+            self._set_arrays(lcletters, labels, alphabet)
+
+        # Create a dataset from the arrays computed previously by another `Dataset`.
+        @staticmethod
+        def _from_arrays(
+            text: str, window: int, alphabet: list[str], lcletters: np.ndarray, labels: np.ndarray,
+        ) -> "UppercaseData.Dataset":
+            dataset = UppercaseData.Dataset.__new__(UppercaseData.Dataset)
+            dataset._window, dataset._text, dataset._size = window, text, len(text)
+            dataset._set_arrays(lcletters, labels, alphabet)
+            return dataset
+
+        def _set_arrays(self, lcletters: np.ndarray, labels: np.ndarray, alphabet: list[str]) -> None:
+            # Generate input batches; the windows are a read-only zero-copy view of the `lcletters`
+            windows = np.lib.stride_tricks.sliding_window_view(lcletters, 2 * self._window + 1)
+            self._lcletters, self._alphabet = lcletters, alphabet
+            self._data = {"windows": windows, "labels": labels}
+
+        # Return the text split into contiguous segments of `segment_length` characters, for models
+        # labeling all positions of a segment at once. The result is a dictionary with keys
+        # - "segments": lowercased character indices with shape `[segments, segment_length + 2 * context]`,
+        #      each segment extended by `context` characters on both sides; it is again a read-only view
+        # - "labels": labels of the segment characters with shape `[segments, segment_length]`
+        # - "mask": a boolean mask of the same shape, whether the position is a character of the text
+        # The last segment is padded by "<pad>" characters with label 0, which are not in the mask.
+        def segments(self, segment_length: int, context: int = 0) -> dict[str, np.ndarray]:
+            segments = -(-self._size // segment_length)
+            lcletters = np.zeros(segments * segment_length + 2 * context, np.int16)
+            lcletters[context:context + self._size] = self._lcletters[self._window:self._window + self._size]
+            labels = np.zeros(segments * segment_length, np.uint8)
+            labels[:self._size] = self._data["labels"]
+            return {
+                "segments": np.lib.stride_tricks.sliding_window_view(
+                    lcletters, segment_length + 2 * context)[::segment_length],
+                "labels": labels.reshape(segments, segment_length),
+                "mask": (np.arange(segments * segment_length) < self._size).reshape(segments, segment_length),
+            }
+
+        # Return the text with the characters uppercased where `predictions` (an array with shape `[size]`)
+        # are nonzero, and lowercased elsewhere. Characters whose upper()/lower() variant consists of
+        # several characters (like "ß") are kept unchanged, so the result has the same length as the text.
+        def recase(self, predictions: np.ndarray) -> str:
+            codes = UppercaseData._code_points(self._text)
+            if len(predictions) != len(codes):
+                raise ValueError("UppercaseData: The predictions have length {}, expected {}.".format(
+                    len(predictions), len(codes)))
+
+            def recase_table(function: Callable[[str], str]) -> np.ndarray:
+                return UppercaseData._lookup_table(
+                    codes, lambda char: ord(function(char)) if len(function(char)) == 1 else ord(char), np.uint32)
+            uppercase, lowercase = recase_table(str.upper), recase_table(str.lower)
+            codes = np.where(np.asarray(predictions) != 0, uppercase[codes], lowercase[codes])
+            return codes.astype("<u4").tobytes().decode("utf-32-le")
 
         @property
         def alphabet(self) -> list[str]:
@@ -101,27 +163,205 @@ class UppercaseData:
         def size(self) -> int:
             return self._size
 
-    def __init__(self, window: int, alphabet_size: int = 0):
+    # With `workers` other than 1, the datasets are preprocessed in that many worker processes
+    # (all cores for `workers=0`), including the counting of characters for the alphabet. The
+    # processes are started with `spawn`, which imports the main script again in every one of them,
+    # so the pool is used only for texts of at least `_PARALLEL_MIN_SIZE` bytes.
+    def __init__(self, window: int, alphabet_size: int = 0, cache_dir: str | None = None, workers: int = 1):
         path = os.path.basename(self._URL)
         if not os.path.exists(path):
             print("Downloading dataset {}...".format(path), file=sys.stderr)
             urllib.request.urlretrieve(self._URL, filename="{}.tmp".format(path))
             os.rename("{}.tmp".format(path), path)
 
+        # The cache is keyed by the checksum of the data, `window`, and `alphabet_size`.
+        if cache_dir is not None:
+            with open(path, "rb") as zip_file:
+                checksum = hashlib.file_digest(zip_file, "sha1").hexdigest()
+            cache = os.path.join(cache_dir, "{}-window{}-alphabet{}".format(checksum[:16], window, alphabet_size))
+            if os.path.exists(cache):
+                self._load_cache(cache, window)
+                return
+
+        texts = {}
         with zipfile.ZipFile(path, "r") as zip_file:
             for dataset in ["train", "dev", "test"]:
                 with zip_file.open("{}_{}.txt".format(os.path.splitext(path)[0], dataset), "r") as dataset_file:
-                    data = dataset_file.read().decode("utf-8")
+                    texts[dataset] = dataset_file.read()
+
+        if workers != 1 and sum(len(text) for text in texts.values()) >= self._PARALLEL_MIN_SIZE:
+            self._parallel_preprocess(texts, window, alphabet_size, workers)
+        else:
+            for dataset, data in texts.items():
                 setattr(self, dataset, self.Dataset(
-                    data,
+                    data.decode("utf-8"),
                     window,
                     alphabet=alphabet_size if dataset == "train" else self.train.alphabet,
                 ))
 
+        if cache_dir is not None:
+            self._save_cache(cache)
+
     train: Dataset
     dev: Dataset
     test: Dataset
 
+    def _save_cache(self, cache: str) -> None:
+        # The cache is written to a temporary directory first, and then renamed atomically.
+        temporary = "{}.tmp{}".format(cache, os.getpid())
+        os.makedirs(temporary)
+        with open(os.path.join(temporary, "alphabet.json"), "w", encoding="utf-8") as alphabet_file:
+            json.dump(self.train.alphabet, alphabet_file, ensure_ascii=False)
+        for dataset in ["train", "dev", "test"]:
+            data, prefix = getattr(self, dataset), os.path.join(temporary, dataset)
+            with open("{}.txt".format(prefix), "w", encoding="utf-8", newline="") as text_file:
+                text_file.write(data.text)
+            np.save("{}_lcletters.npy".format(prefix), data._lcletters)
+            np.save("{}_labels.npy".format(prefix), data.data["labels"])
+        try:
+            os.rename(temporary, cache)
+        except OSError:  # The cache has been created by another process in the meantime.
+            shutil.rmtree(temporary)
+
+    def _load_cache(self, cache: str, window: int) -> None:
+        with open(os.path.join(cache, "alphabet.json"), "r", encoding="utf-8") as alphabet_file:
+            alphabet = json.load(alphabet_file)
+        for dataset in ["train", "dev", "test"]:
+            with open(os.path.join(cache, "{}.txt".format(dataset)), "r", encoding="utf-8", newline="") as text_file:
+                text = text_file.read()
+            setattr(self, dataset, self.Dataset._from_arrays(
+                text,
+                window,
+                list(alphabet),
+                np.load(os.path.join(cache, "{}_lcletters.npy".format(dataset)), mmap_mode="r"),
+                np.load(os.path.join(cache, "{}_labels.npy".format(dataset)), mmap_mode="r"),
+            ))
+
+    # Stream batches of windows and labels of a text, without loading it into memory in full.
+    # The `path` is either the dataset zip (in which case `dataset` selects the text in it) or
+    # a plain UTF-8 text file; the text is read in chunks of `chunk_size` characters, keeping
+    # `2 * window` characters of context between the chunks. The `alphabet` must be a list
+    # starting with "<pad>" and "<unk>", usually `train.alphabet` of a loaded `UppercaseData`.
+    # All yielded batches contain `batch_size` examples, except possibly the last one.
+    @staticmethod
+    def stream(
+        path: str, window: int, alphabet: list[str], batch_size: int,
+        dataset: str = "train", chunk_size: int = 1 << 20,
+    ) -> Iterator[dict[str, np.ndarray]]:
+        if alphabet[:2] != ["<pad>", "<unk>"]:
+            raise ValueError("UppercaseData: The alphabet must start with <pad> and <unk>.")
+        alphabet_map = {letter: index for index, letter in enumerate(alphabet)}
+
+        with contextlib.ExitStack() as stack:
+            if zipfile.is_zipfile(path):
+                zip_file = stack.enter_context(zipfile.ZipFile(path, "r"))
+                text_file = stack.enter_context(io.TextIOWrapper(zip_file.open("{}_{}.txt".format(
+                    os.path.splitext(os.path.basename(path))[0], dataset), "r"), encoding="utf-8", newline=""))
+            else:
+                text_file = stack.enter_context(open(path, "r", encoding="utf-8", newline=""))
+
+            # The `lcletters` and `labels` contain the characters not yet yielded (plus the context).
+            lcletters, labels = np.zeros(window, np.int16), np.zeros(0, np.uint8)
+            while True:
+                chunk = text_file.read(chunk_size)
+                codes = UppercaseData._code_points(chunk)
+                lcletters = np.concatenate([lcletters, UppercaseData._lookup_table(
+                    codes, lambda char: alphabet_map.get(char.lower(), alphabet_map["<unk>"]), np.int16)[codes]])
+                labels = np.concatenate([labels, UppercaseData._lookup_table(codes, str.isupper, np.uint8)[codes]])
+                if not chunk:
+                    lcletters = np.concatenate([lcletters, np.zeros(window, np.int16)])
+
+                # Yield all complete batches, and after the last chunk also the remaining examples.
+                size = len(labels) if not chunk else max(len(lcletters) - 2 * window, 0) // batch_size * batch_size
+                if size:
+                    windows = np.lib.stride_tricks.sliding_window_view(lcletters[:size + 2 * window], 2 * window + 1)
+                    for i in range(0, size, batch_size):
+                        yield {"windows": windows[i:i + batch_size], "labels": labels[i:i + batch_size]}
+                    lcletters, labels = lcletters[size:], labels[size:]
+                if not chunk:
+                    break
+
+    # Preprocess the UTF-8 encoded texts in a pool of `workers` processes. The texts are split into
+    # chunks ending after a newline, so that `lower()` of every chunk gives the same result as in the
+    # whole text (a final sigma depends on its context). The workers first count the characters of
+    # the train chunks, whose counts are merged into the alphabet, and then compute the lowercased
+    # character indices and labels of the chunks of all datasets. The chunks are passed as `bytes`
+    # and the results as arrays, both of which are pickled by a plain copy.
+    def _parallel_preprocess(self, texts: dict[str, bytes], window: int, alphabet_size: int, workers: int) -> None:
+        chunks = {dataset: self._split_chunks(text) for dataset, text in texts.items()}
+        with concurrent.futures.ProcessPoolExecutor(workers or None, multiprocessing.get_context("spawn")) as executor:
+            counts = list(executor.map(UppercaseData._count_chars, chunks["train"]))
+            offsets = np.cumsum([0] + [length for _, _, _, length in counts])
+
+            # Merge the counts of the chunks; the first occurrence is the minimum over the chunks.
+            chars, indices = np.unique(np.concatenate([chars for chars, _, _, _ in counts]), return_inverse=True)
+            freqs, firsts = np.zeros(len(chars), np.int64), np.full(len(chars), offsets[-1])
+            np.add.at(freqs, indices, np.concatenate([freqs for _, freqs, _, _ in counts]))
+            np.minimum.at(firsts, indices, np.concatenate([
+                firsts + offset for (_, _, firsts, _), offset in zip(counts, offsets)]))
+            alphabet = ["<pad>", "<unk>"] + self._most_frequent(chars, freqs, firsts, alphabet_size)
+
+            results = {
+                dataset: executor.map(UppercaseData._preprocess, dataset_chunks, [alphabet] * len(dataset_chunks))
+                for dataset, dataset_chunks in chunks.items()
+            }
+            for dataset, text in texts.items():
+                lcletters, labels = map(list, zip(*results[dataset]))
+                size = sum(len(chunk_labels) for chunk_labels in labels)
+                padded = np.zeros(size + 2 * window, np.int16)
+                np.concatenate(lcletters, out=padded[window:window + size])
+                setattr(self, dataset, self.Dataset._from_arrays(
+                    text.decode("utf-8"), window, alphabet, padded, np.concatenate(labels)))
+
+    # Split the UTF-8 encoded text into chunks of roughly `chunk_size` bytes ending after a newline.
+    @staticmethod
+    def _split_chunks(text: bytes, chunk_size: int = 1 << 20) -> list[bytes]:
+        chunks, start = [], 0
+        while start < len(text):
+            end = text.find(b"\n", start + chunk_size) + 1 or len(text)
+            chunks.append(text[start:end])
+            start = end
+        return chunks or [b""]
+
+    # Return the code points of the lowercased characters of the text, their frequencies and
+    # first occurrences, together with the length of the lowercased text.
+    @staticmethod
+    def _count_chars(text: str | bytes) -> tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+        if isinstance(text, bytes):
+            text = text.decode("utf-8")
+        lccodes = UppercaseData._code_points(text.lower())
+        freqs, firsts = np.bincount(lccodes), np.full(lccodes.max(initial=0) + 1, len(lccodes))
+        np.minimum.at(firsts, lccodes, np.arange(len(lccodes)))
+        chars = np.flatnonzero(freqs)
+        return chars, freqs[chars], firsts[chars], len(lccodes)
+
+    # Return the characters occurring in the text ordered by decreasing frequency, with ties broken
+    # by the first occurrence; for nonzero `alphabet_size`, only as many as fit in the alphabet.
+    @staticmethod
+    def _most_frequent(chars: np.ndarray, freqs: np.ndarray, firsts: np.ndarray, alphabet_size: int) -> list[str]:
+        chars = chars[np.lexsort((firsts, -freqs))]
+        return [chr(char) for char in (chars[:max(alphabet_size - 2, 1)] if alphabet_size else chars)]
+
+    # Return the lowercased character indices and the labels of a UTF-8 encoded text chunk.
+    @staticmethod
+    def _preprocess(text: bytes, alphabet: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        dataset = UppercaseData.Dataset(text.decode("utf-8"), 0, alphabet)
+        return dataset._lcletters, dataset.data["labels"]
+
+    # Return the Unicode code points of the given text.
+    @staticmethod
+    def _code_points(text: str) -> np.ndarray:
+        return np.frombuffer(text.encode("utf-32-le"), np.uint32)
+
+    # Return a lookup table indexed by code points, containing the results of `function`
+    # for the characters occurring in `codes` (and zeros for all other code points).
+    @staticmethod
+    def _lookup_table(codes: np.ndarray, function: Callable[[str], Any], dtype: np.dtype) -> np.ndarray:
+        chars = np.flatnonzero(np.bincount(codes))
+        table = np.zeros(chars[-1] + 1 if len(chars) else 1, dtype)
+        table[chars] = [function(chr(char)) for char in chars]
+        return table
+
     # Evaluation infrastructure.
     @staticmethod
     def evaluate(gold_dataset: Dataset, predictions: str) -> float:
@@ -131,15 +371,26 @@ class UppercaseData:
             raise RuntimeError("The predictions are shorter than gold data: {} vs {}.".format(
                 len(predictions), len(gold)))
 
-        correct = 0
-        for i in range(len(gold)):
-            # Note that just the lower() condition is not enough, for example
-            # u03c2 and u03c3 have both u03c2 as an uppercase character.
-            if predictions[i].lower() != gold[i].lower() and predictions[i].upper() != gold[i].upper():
-                raise RuntimeError("The predictions and gold data differ on position {}: {} vs {}.".format(
-                    i, repr(predictions[i:i + 20].lower()), repr(gold[i:i + 20].lower())))
+        # Compare the code points of all characters at once, using lookup tables mapping every
+        # code point to an identifier of its lower() and upper() variant, respectively.
+        gold_codes = UppercaseData._code_points(gold)
+        predictions_codes = UppercaseData._code_points(predictions[:len(gold)])
+        codes = np.concatenate([gold_codes, predictions_codes])
+        lower_ids, upper_ids = {}, {}
+        lower = UppercaseData._lookup_table(
+            codes, lambda char: lower_ids.setdefault(char.lower(), len(lower_ids)), np.int32)
+        upper = UppercaseData._lookup_table(
+            codes, lambda char: upper_ids.setdefault(char.upper(), len(upper_ids)), np.int32)
+
+        # Note that just the lower() condition is not enough, for example
+        # u03c2 and u03c3 have both u03c2 as an uppercase character.
+        differ = (lower[predictions_codes] != lower[gold_codes]) & (upper[predictions_codes] != upper[gold_codes])
+        if differ.any():
+            i = int(differ.argmax())
+            raise RuntimeError("The predictions and gold data differ on position {}: {} vs {}.".format(
+                i, repr(predictions[i:i + 20].lower()), repr(gold[i:i + 20].lower())))
 
-            correct += gold[i] == predictions[i]
+        correct = int(np.count_nonzero(predictions_codes == gold_codes))
         return 100 * correct / len(gold)
 
     @staticmethod
@@ -1,7 +1,17 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
+import json
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
 import os
 import sys
-from typing import Any, Callable, Sequence, TextIO
+import tempfile
+import time
+from typing import Any, Callable, Iterator, Sequence, TextIO
 import urllib.request
+import zipfile
 
 import numpy as np
 import torch
@@ -29,8 +39,18 @@ class CIFAR10:
         def size(self) -> int:
             return self._size
 
-        def dataset(self, transform: Callable[[dict[str, np.ndarray]], Any] | None = None) -> torch.utils.data.Dataset:
-            return CIFAR10.TorchDataset(self, transform)
+        # Move the arrays into PyTorch shared-memory tensors (keeping them available as NumPy arrays),
+        # so that the `DataLoader` workers read the same pages instead of gradually getting private
+        # copies of them; call it before the workers are started.
+        def share_memory(self) -> "CIFAR10.Dataset":
+            for key, value in self._data.items():
+                self._data[key] = torch.from_numpy(np.array(value)).share_memory_().numpy()
+            return self
+
+        def dataset(
+            self, transform: Callable[[dict[str, np.ndarray]], Any] | None = None, batched: bool = False,
+        ) -> torch.utils.data.Dataset:
+            return (CIFAR10.BatchedTorchDataset if batched else CIFAR10.TorchDataset)(self, transform)
 
     class TorchDataset(torch.utils.data.Dataset):
         def __init__(self, dataset: "CIFAR10.Dataset",
@@ -47,23 +67,253 @@ class CIFAR10:
                 item = self._transform(item)
             return item
 
-    def __init__(self, size: dict[str, int] = {}) -> None:
+    # A dataset gathering whole batches: the `torch.utils.data.DataLoader` passes all indices
+    # of a batch to `__getitems__`, which fetches every array with a single fancy index, and the
+    # `transform` is then applied to the whole batch. The dataset must be used together with
+    # `collate_fn=CIFAR10.BatchedTorchDataset.collate` of the `DataLoader`.
+    class BatchedTorchDataset(TorchDataset):
+        # Return a single example, unbatched from a batch of one, so that the dataset can also be indexed directly.
+        def __getitem__(self, index: int) -> Any:
+            return self._unbatch(self.__getitems__([index]))
+
+        def __getitems__(self, indices: list[int]) -> Any:
+            indices = np.asarray(indices)
+            batch = {key: value[indices] for key, value in self._dataset.data.items()}
+            if self._transform is not None:
+                batch = self._transform(batch)
+            return batch
+
+        @staticmethod
+        def collate(batch: Any) -> Any:
+            return torch.utils.data.default_convert(batch)
+
+        # Return the only example of a batch of one, keeping the dictionaries, tuples and lists of the batch.
+        @staticmethod
+        def _unbatch(batch: Any) -> Any:
+            if isinstance(batch, dict):
+                return {key: CIFAR10.BatchedTorchDataset._unbatch(value) for key, value in batch.items()}
+            if isinstance(batch, (tuple, list)):
+                return type(batch)(CIFAR10.BatchedTorchDataset._unbatch(value) for value in batch)
+            return batch[0]
+
+    # Precomputes `epochs` augmented epochs of the given dataset in background worker processes,
+    # so that the augmentation does not compete with the training for the same cores. The images
+    # of every epoch are written by shards of `shard_size` examples into a memory-mapped uint8 file
+    # `{path}/epoch_{epoch}.npy`, and `epoch(epoch)` then returns a `CIFAR10.Dataset` reading it.
+    #
+    # The `transform` gets a `[H, W, C]` uint8 image and returns the augmented one; it must be picklable
+    # (for example a module-level function or a `v2.Compose`). Before every image, the PyTorch and NumPy
+    # generators are seeded by a seed derived from `(seed, epoch, index)`, so the results are
+    # deterministic and independent of the number of workers.
+    class AugmentedEpochs:
+        def __init__(
+            self, dataset: "CIFAR10.Dataset", transform: Callable[[np.ndarray], Any], epochs: int, path: str,
+            seed: int = 42, workers: int | None = None, shard_size: int = 1_000,
+        ) -> None:
+            self._labels, self._path = dataset.data["labels"], path
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                workers, multiprocessing.get_context("spawn"), initializer=torch.set_num_threads, initargs=(1,))
+
+            os.makedirs(path, exist_ok=True)
+            images, self._shards = dataset.data["images"], []
+            for epoch in range(epochs):
+                np.lib.format.open_memmap(self._epoch_path(epoch), "w+", np.uint8, images.shape).flush()
+                self._shards.append([self._executor.submit(
+                    CIFAR10._augment_shard, self._epoch_path(epoch), start, images[start:start + shard_size],
+                    transform, seed, epoch) for start in range(0, len(images), shard_size)])
+
+        def epoch(self, epoch: int) -> "CIFAR10.Dataset":
+            for shard in self._shards[epoch]:
+                shard.result()
+            return CIFAR10.Dataset({"images": np.load(self._epoch_path(epoch), mmap_mode="c"), "labels": self._labels})
+
+        def close(self) -> None:
+            self._executor.shutdown(cancel_futures=True)
+
+        def __enter__(self) -> "CIFAR10.AugmentedEpochs":
+            return self
+
+        def __exit__(self, *args) -> None:
+            self.close()
+
+        def _epoch_path(self, epoch: int) -> str:
+            return os.path.join(self._path, "epoch_{}.npy".format(epoch))
+
+    @staticmethod
+    def _augment_shard(
+        path: str, start: int, images: np.ndarray, transform: Callable[[np.ndarray], Any], seed: int, epoch: int,
+    ) -> None:
+        augmented = np.lib.format.open_memmap(path, "r+")
+        for index, image in enumerate(images, start):
+            image_seed = int(np.random.SeedSequence([seed, epoch, index]).generate_state(1)[0])
+            torch.manual_seed(image_seed)
+            np.random.seed(image_seed)
+            augmented[index] = np.asarray(transform(image))
+        augmented.flush()
+
+    def __init__(self, size: dict[str, int] = {}, shared: bool = False) -> None:
         path = os.path.basename(self._URL)
         if not os.path.exists(path):
             print("Downloading CIFAR-10 dataset...", file=sys.stderr)
             urllib.request.urlretrieve(self._URL, filename="{}.tmp".format(path))
             os.rename("{}.tmp".format(path), path)
 
-        cifar = np.load(path)
+        cifar = self._load_shared(path, size) if shared else self._load(path, size)
         for dataset in ["train", "dev", "test"]:
-            data = {key[len(dataset) + 1:]: cifar[key][:size.get(dataset, None)]
-                    for key in cifar if key.startswith(dataset)}
+            data = {key[len(dataset) + 1:]: cifar[key] for key in cifar if key.startswith(dataset)}
             setattr(self, dataset, self.Dataset(data))
 
     train: Dataset
     dev: Dataset
     test: Dataset
 
+    # Load the arrays of the given `.npz` file. When `size` limits a dataset, only the leading
+    # rows of its arrays are read (and decompressed), instead of loading the arrays in full.
+    @staticmethod
+    def _load(path: str, size: dict[str, int]) -> dict[str, np.ndarray]:
+        arrays = {}
+        with zipfile.ZipFile(path, "r") as npz_file:
+            for name in npz_file.namelist():
+                key, rows = name.removesuffix(".npy"), size.get(name.split("_", 1)[0], None)
+                with npz_file.open(name, "r") as npy_file:
+                    version = np.lib.format.read_magic(npy_file)
+                    if rows is not None and version in [(1, 0), (2, 0)]:
+                        read_header = getattr(np.lib.format, "read_array_header_{}_{}".format(*version))
+                        shape, fortran_order, dtype = read_header(npy_file)
+                        if shape and not fortran_order and not dtype.hasobject:
+                            array = np.empty([min(rows, shape[0]), *shape[1:]], dtype)
+                            if array.size and npy_file.readinto(memoryview(array).cast("B")) != array.nbytes:
+                                raise RuntimeError("The array {} in {} is truncated.".format(key, path))
+                            arrays[key] = array
+                            continue
+                with npz_file.open(name, "r") as npy_file:
+                    arrays[key] = np.lib.format.read_array(npy_file)[:rows]
+        return arrays
+
+    # Segments of the datasets in shared memory, which were attached by this process.
+    _shared_segments: dict[str, list[shared_memory.SharedMemory]] = {}
+
+    # Load the arrays through a cross-process registry in shared memory. The first process
+    # publishes the arrays as named shared-memory segments, and all later loads of the same
+    # file and `size` (in this or any other process) attach to them read-only without copying.
+    # The segments outlive the processes using them; use `unlink_shared` to remove them.
+    #
+    # Publishing is serialized by `_shared_lock`, which the operating system releases even when its
+    # holder is killed. A process unable to attach waits for the lock and tries attaching again, so
+    # concurrent loads publish the arrays only once; if there is still no complete manifest, no other
+    # process is publishing, so any existing segments were left by a killed publisher and are replaced.
+    @staticmethod
+    def _load_shared(path: str, size: dict[str, int]) -> dict[str, np.ndarray]:
+        name = CIFAR10._shared_name(path, size)
+        try:
+            return CIFAR10._attach_shared(name)
+        except (FileNotFoundError, ValueError):  # Not published yet, or the manifest is being written.
+            pass
+
+        with CIFAR10._shared_lock(name):
+            try:
+                return CIFAR10._attach_shared(name)
+            except (FileNotFoundError, ValueError):
+                pass
+            arrays = CIFAR10._load(path, size)
+            CIFAR10._unlink_shared_segments(name)
+            CIFAR10._publish_shared(name, arrays)
+            return CIFAR10._attach_shared(name)
+
+    # Hold an exclusive lock of the file `{name}.lock` in the temporary directory; the file is kept,
+    # because removing it could let two processes lock different files of the same name.
+    @staticmethod
+    @contextlib.contextmanager
+    def _shared_lock(name: str) -> Iterator[None]:
+        with open(os.path.join(tempfile.gettempdir(), "{}.lock".format(name)), "a+b") as lock_file:
+            if os.name == "nt":
+                import msvcrt
+                while True:
+                    try:
+                        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)  # Retries for 10s, then raises.
+                        break
+                    except OSError:
+                        pass
+            else:
+                import fcntl
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield  # The lock is released by closing the file.
+
+    @staticmethod
+    def _shared_name(path: str, size: dict[str, int]) -> str:
+        key = repr((os.path.abspath(path), os.path.getmtime(path), sorted(size.items())))
+        return "npfl138_{}".format(hashlib.sha1(key.encode()).hexdigest()[:16])
+
+    @staticmethod
+    def _shared_segment(name: str, size: int = 0) -> shared_memory.SharedMemory:
+        segment = shared_memory.SharedMemory(name, create=size > 0, size=size)
+        # Otherwise the resource tracker would unlink the segment when this process exits.
+        resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+    @staticmethod
+    def _unlink_segment(segment: shared_memory.SharedMemory) -> None:
+        resource_tracker.register(segment._name, "shared_memory")  # Balances the unregistration in `unlink`.
+        segment.unlink()
+
+    # The array segments are named `{name}_{i}`; the manifest segment `{name}` describing them
+    # is created only after all arrays are copied, and is complete once it is valid JSON.
+    @staticmethod
+    def _publish_shared(name: str, arrays: dict[str, np.ndarray]) -> None:
+        segments, manifest = [], []
+        try:
+            for i, (key, array) in enumerate(arrays.items()):
+                segments.append(CIFAR10._shared_segment("{}_{}".format(name, i), max(array.nbytes, 1)))
+                np.ndarray(array.shape, array.dtype, buffer=segments[-1].buf)[...] = array
+                manifest.append([key, array.dtype.str, array.shape])
+            manifest = json.dumps(manifest).encode()
+            segments.append(CIFAR10._shared_segment(name, len(manifest)))
+            segments[-1].buf[:len(manifest)] = manifest
+        except BaseException:
+            for segment in segments:
+                CIFAR10._unlink_segment(segment)
+            raise
+        finally:
+            for segment in segments:
+                segment.close()
+
+    @staticmethod
+    def _attach_shared(name: str) -> dict[str, np.ndarray]:
+        segments = CIFAR10._shared_segments.get(name) or [CIFAR10._shared_segment(name)]
+        try:
+            manifest = json.loads(bytes(segments[0].buf).rstrip(b"\0"))
+        except ValueError:
+            segments[0].close()
+            raise
+        if name not in CIFAR10._shared_segments:
+            segments += [CIFAR10._shared_segment("{}_{}".format(name, i)) for i in range(len(manifest))]
+            CIFAR10._shared_segments[name] = segments
+
+        arrays = {}
+        for (key, dtype, shape), segment in zip(manifest, segments[1:]):
+            arrays[key] = np.ndarray(shape, dtype, buffer=segment.buf)
+            arrays[key].flags.writeable = False
+        return arrays
+
+    # Remove the shared-memory segments published by `CIFAR10(..., shared=True)` with the same arguments.
+    # Processes which already attached to them keep their data until they exit.
+    @staticmethod
+    def unlink_shared(size: dict[str, int] = {}) -> None:
+        name = CIFAR10._shared_name(os.path.basename(CIFAR10._URL), size)
+        CIFAR10._unlink_shared_segments(name)
+
+    @staticmethod
+    def _unlink_shared_segments(name: str) -> None:
+        for i in itertools.count():
+            try:
+                CIFAR10._unlink_segment(CIFAR10._shared_segment("{}_{}".format(name, i)))
+            except FileNotFoundError:
+                break
+        try:
+            CIFAR10._unlink_segment(CIFAR10._shared_segment(name))
+        except FileNotFoundError:
+            pass
+
     # Evaluation infrastructure.
     @staticmethod
     def evaluate(gold_dataset: Dataset, predictions: Sequence[int]) -> float:
@@ -82,13 +332,53 @@ class CIFAR10:
         return CIFAR10.evaluate(gold_dataset, predictions)
 
 
+# Report the PID of a `DataLoader` worker; a module-level function, so that it can be pickled
+# by the `spawn` start method (the default on macOS and Windows).
+def _put_worker_pid(queue: multiprocessing.SimpleQueue, worker_id: int) -> None:
+    queue.put(os.getpid())
+
+
 if __name__ == "__main__":
     import argparse
+    import functools
     parser = argparse.ArgumentParser()
     parser.add_argument("--evaluate", default=None, type=str, help="Prediction file to evaluate")
     parser.add_argument("--dataset", default="dev", type=str, help="Gold dataset to evaluate")
+    parser.add_argument("--benchmark_loader", default=False, action="store_true", help="Benchmark the data loading")
+    parser.add_argument("--batch_size", default=50, type=int, help="Batch size of the loader benchmark")
+    parser.add_argument("--num_workers", default=0, type=int, help="Loader workers of the loader benchmark")
+    parser.add_argument("--share_memory", default=False, action="store_true", help="Share the loader benchmark data")
     args = parser.parse_args()
 
+    # Return the memory usage of the given process in MB, from the Linux `/proc/{pid}/smaps_rollup`;
+    # on other systems, the memory usage of the workers is not reported.
+    def memory_usage(pid: int) -> dict[str, float]:
+        with open("/proc/{}/smaps_rollup".format(pid), "r") as smaps_file:
+            usage = {line.split()[0].rstrip(":"): int(line.split()[1]) / 1024 for line in smaps_file if "kB" in line}
+        return {"rss": usage["Rss"], "pss": usage["Pss"], "private": usage["Private_Clean"] + usage["Private_Dirty"]}
+
+    if args.benchmark_loader:
+        cifar = CIFAR10()
+        if args.share_memory:
+            cifar.train.share_memory()
+        for name, dataset, collate_fn in [
+            ("per-example", cifar.train.dataset(), None),
+            ("batched", cifar.train.dataset(batched=True), CIFAR10.BatchedTorchDataset.collate),
+        ]:
+            worker_pids = multiprocessing.SimpleQueue()
+            loader = torch.utils.data.DataLoader(
+                dataset, args.batch_size, shuffle=True, collate_fn=collate_fn, num_workers=args.num_workers,
+                persistent_workers=args.num_workers > 0,
+                worker_init_fn=functools.partial(_put_worker_pid, worker_pids))
+            start = time.time()
+            for batch in loader:
+                pass
+            print("Loading with {} dataset: {:.1f} batches/s".format(name, len(loader) / (time.time() - start)))
+            for worker in range(args.num_workers if os.path.exists("/proc/self/smaps_rollup") else 0):
+                print("  Worker {} memory: {}".format(worker, ", ".join("{} {:.1f}MB".format(key, value) for key, value
+                                                                          in memory_usage(worker_pids.get()).items())))
+            del loader
+
     if args.evaluate:
         with open(args.evaluate, "r", encoding="utf-8-sig") as predictions_file:
             accuracy = CIFAR10.evaluate_file(getattr(CIFAR10(), args.dataset), predictions_file)
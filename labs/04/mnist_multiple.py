@@ -92,18 +92,32 @@ class Model(keras.Model):
 
         # The new dataset should be created from consecutive _pairs_ of examples.
         # You can assume that the size of the original dataset is even.
+        #
+        # All pairs and their targets are precomputed at once using reshapes and comparisons,
+        # and the dataset is indexed by whole batches of indices (see `create_loader` in `main`),
+        # so no per-example Python code runs during the training.
+        pairs, digits = images.reshape(-1, 2, *images.shape[1:]), labels.reshape(-1, 2)
+        comparison = (digits[:, 0] > digits[:, 1]).astype(np.float32)
+        inputs = (pairs[:, 0], pairs[:, 1])
+        outputs = {
+            "digit_1": digits[:, 0],
+            "digit_2": digits[:, 1],
+            "direct_comparison": comparison,
+            "indirect_comparison": comparison,
+        }
+
         class TorchDataset(torch.utils.data.Dataset):
             def __len__(self) -> int:
-                # TODO: The new dataset has half the size of the original one.
-                return ...
+                # The new dataset has half the size of the original one.
+                return len(digits)
 
-            def __getitem__(self, index: int) -> tuple[tuple[np.ndarray, np.ndarray], dict[str, np.ndarray]]:
-                # TODO: Given an `index`, generate a dataset element suitable for our model.
-                # Notably, the element should be a pair `(input, output)`, with
-                # - `input` being a pair of images `(images[2 * index], images[2 * index + 1])`,
-                # - `output` being a dictionary with keys "digit_1", "digit_2", "direct_comparison",
-                #   and "indirect_comparison".
-                return ...
+            def __getitem__(
+                self, index: int | list[int],
+            ) -> tuple[tuple[np.ndarray, np.ndarray], dict[str, np.ndarray]]:
+                # Given an `index` (or a list of indices of a whole batch), return a pair `(input, output)`,
+                # with `input` being a pair of images `(images[2 * index], images[2 * index + 1])` and `output`
+                # being a dictionary with keys "digit_1", "digit_2", "direct_comparison", "indirect_comparison".
+                return (inputs[0][index], inputs[1][index]), {key: value[index] for key, value in outputs.items()}
 
         return TorchDataset()
 
@@ -121,9 +135,15 @@ def main(args: argparse.Namespace) -> dict[str, float]:
     # Create the model
     model = Model(args)
 
-    # Construct suitable dataloaders from the MNIST data.
-    train = torch.utils.data.DataLoader(model.create_dataset(mnist.train, args), args.batch_size, shuffle=True)
-    dev = torch.utils.data.DataLoader(model.create_dataset(mnist.dev, args), args.batch_size)
+    # Construct suitable dataloaders from the MNIST data. The sampler generates whole batches of
+    # indices, so that the dataset is indexed just once per batch and no collation is needed.
+    def create_loader(dataset: torch.utils.data.Dataset, shuffle: bool) -> torch.utils.data.DataLoader:
+        sampler = (torch.utils.data.RandomSampler if shuffle else torch.utils.data.SequentialSampler)(dataset)
+        batch_sampler = torch.utils.data.BatchSampler(sampler, args.batch_size, drop_last=False)
+        return torch.utils.data.DataLoader(dataset, batch_size=None, sampler=batch_sampler)
+
+    train = create_loader(model.create_dataset(mnist.train, args), shuffle=True)
+    dev = create_loader(model.create_dataset(mnist.dev, args), shuffle=False)
 
     # Train
     logs = model.fit(train, epochs=args.epochs, validation_data=dev)
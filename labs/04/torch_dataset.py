@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import time
 os.environ.setdefault("KERAS_BACKEND", "torch")  # Use PyTorch backend unless specified otherwise
 
 import numpy as np
@@ -14,6 +15,7 @@ parser = argparse.ArgumentParser()
 # These arguments will be set appropriately by ReCodEx, even if you change them.
 parser.add_argument("--augment", default=False, action="store_true", help="Whether to augment the data.")
 parser.add_argument("--batch_size", default=50, type=int, help="Batch size.")
+parser.add_argument("--benchmark_augmentation", default=False, action="store_true", help="Benchmark augmentation.")
 parser.add_argument("--epochs", default=5, type=int, help="Number of epochs.")
 parser.add_argument("--recodex", default=False, action="store_true", help="Evaluation in ReCodEx.")
 parser.add_argument("--seed", default=42, type=int, help="Random seed.")
@@ -22,6 +24,76 @@ parser.add_argument("--threads", default=1, type=int, help="Maximum number of th
 # If you add more arguments, ReCodEx will keep them with your default values.
 
 
+# Vectorized version of the `--augment` transformations for whole uint8 batches. Every example
+# gets its own random parameters of `v2.RandomResize(min_size, max_size)`, `v2.Pad(padding)`,
+# `v2.RandomCrop(size)` and `v2.RandomHorizontalFlip()`, but the resize, pad, crop and flip of all
+# examples are composed into a single sampling grid, so the whole batch is processed by one bilinear
+# `grid_sample` call. The results differ from the per-image transformations only by rounding and
+# by the resize not being antialiased when downscaling.
+#
+# The batch is `[N, H, W, C]` when `channels_last` (processed without copying permutes, using
+# the `channels_last` memory format), and `[N, C, H, W]` otherwise. It can also be used as the
+# batch `transform` of `CIFAR10.Dataset.dataset(..., batched=True)`, after converting images to tensors.
+class BatchAugmentation:
+    def __init__(
+        self, min_size: int = 28, max_size: int = 36, padding: int = 4, size: int = 32,
+        channels_last: bool = True, generator: torch.Generator | None = None,
+    ) -> None:
+        self._min_size, self._max_size, self._padding, self._size = min_size, max_size, padding, size
+        self._channels_last = channels_last
+        self._generator = generator
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        if self._channels_last:
+            images = images.permute(0, 3, 1, 2)
+        n = len(images)
+
+        # Sample the per-example parameters; the images are square, so the shorter side is either side.
+        sizes = torch.randint(self._min_size, self._max_size, [n], generator=self._generator)
+        crop_ranges = sizes + 2 * self._padding - self._size + 1
+        offsets = (torch.rand([2, n], generator=self._generator) * crop_ranges).long()
+        flips = torch.rand([n], generator=self._generator) < 0.5
+
+        # For every output pixel, compute its coordinates in the resized image, and then the normalized
+        # coordinates of the corresponding source pixel (the bilinear resize uses `align_corners=False`).
+        positions = torch.arange(self._size)
+        rows = positions + offsets[0, :, None] - self._padding
+        cols = torch.where(flips[:, None], positions.flip(0), positions) + offsets[1, :, None] - self._padding
+        grid = torch.stack(torch.broadcast_tensors(
+            (2 * cols[:, None, :] + 1) / sizes[:, None, None] - 1,
+            (2 * rows[:, :, None] + 1) / sizes[:, None, None] - 1,
+        ), dim=-1)
+        valid = ((rows >= 0) & (rows < sizes[:, None]))[:, None, :, None] \
+            & ((cols >= 0) & (cols < sizes[:, None]))[:, None, None, :]
+
+        # The "border" padding clamps the coordinates as the resize does, and the padding is then zeroed.
+        outputs = torch.nn.functional.grid_sample(
+            images.float(), grid, mode="bilinear", padding_mode="border", align_corners=False)
+        outputs = outputs.masked_fill_(~valid, 0).round_().clamp_(0, 255).to(torch.uint8)
+        return outputs.permute(0, 2, 3, 1) if self._channels_last else outputs
+
+
+def benchmark_augmentation(cifar: CIFAR10, batch_size: int) -> None:
+    images = torch.from_numpy(cifar.train.data["images"][:5_000])
+
+    transformation = v2.Compose([
+        v2.RandomResize(28, 36), v2.Pad(4), v2.RandomCrop(32), v2.RandomHorizontalFlip(),
+    ])
+    start = time.time()
+    for image in images:
+        transformation(image.permute(2, 0, 1)).permute(1, 2, 0)
+    print("Per-image augmentation: {:.0f} images/s".format(len(images) / (time.time() - start)))
+
+    for channels_last in [True, False]:
+        augmentation = BatchAugmentation(channels_last=channels_last)
+        batches = (images if channels_last else images.permute(0, 3, 1, 2).contiguous()).split(batch_size)
+        start = time.time()
+        for batch in batches:
+            augmentation(batch)
+        print("Batch augmentation ({}): {:.0f} images/s".format(
+            "channels last" if channels_last else "channels first", len(images) / (time.time() - start)))
+
+
 def main(args: argparse.Namespace) -> dict[str, float]:
     # Set the random seed and the number of threads.
     keras.utils.set_random_seed(args.seed)
@@ -32,6 +104,9 @@ def main(args: argparse.Namespace) -> dict[str, float]:
     # Load the data
     cifar = CIFAR10()
 
+    if args.benchmark_augmentation:
+        return benchmark_augmentation(cifar, args.batch_size)
+
     # Create the model
     inputs = keras.Input(shape=[CIFAR10.H, CIFAR10.W, CIFAR10.C])
     hidden = keras.layers.Rescaling(1 / 255)(inputs)
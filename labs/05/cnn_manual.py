@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import time
 os.environ.setdefault("KERAS_BACKEND", "torch")  # Use PyTorch backend unless specified otherwise
 
 import numpy as np
@@ -12,26 +13,72 @@ from mnist import MNIST
 parser = argparse.ArgumentParser()
 # These arguments will be set appropriately by ReCodEx, even if you change them.
 parser.add_argument("--batch_size", default=50, type=int, help="Batch size.")
+parser.add_argument("--benchmark", default=False, action="store_true", help="Benchmark the convolutions.")
+parser.add_argument("--benchmark_fft", default=False, action="store_true", help="Benchmark FFT crossover.")
+parser.add_argument("--checkpoint_every", default=0, type=int, help="Keep only every k-th activation, if given.")
 parser.add_argument("--cnn", default="5-3-2,10-3-2", type=str, help="CNN architecture.")
+parser.add_argument("--convolution", default="auto", choices=["auto", "fft", "im2col", "loop"], help="Algorithm.")
 parser.add_argument("--epochs", default=5, type=int, help="Number of epochs.")
 parser.add_argument("--learning_rate", default=0.01, type=float, help="Learning rate.")
 parser.add_argument("--recodex", default=False, action="store_true", help="Evaluation in ReCodEx.")
 parser.add_argument("--seed", default=42, type=int, help="Random seed.")
 parser.add_argument("--threads", default=1, type=int, help="Maximum number of threads to use.")
 parser.add_argument("--verify", default=False, action="store_true", help="Verify the implementation.")
+parser.add_argument("--verify_every", default=1, type=int, help="Verify every n-th step after the first ones.")
+parser.add_argument("--verify_examples", default=0, type=int, help="Verify only this many batch examples.")
+parser.add_argument("--verify_first", default=0, type=int, help="Verify all of the first n steps.")
 # If you add more arguments, ReCodEx will keep them with your default values.
 
 
+# Schedules the verification of the convolutions: the first `first` steps (forward or backward
+# passes of a layer) are verified, and after them every `every`-th step (none if zero). Only
+# `examples` randomly chosen batch examples are verified, or all of them if zero. The number of
+# verifications and the maximum observed error are recorded in `checks` and `max_error`.
+class Verification:
+    def __init__(self, first: int = 0, every: int = 1, examples: int = 0, seed: int = 42) -> None:
+        self._first, self._every, self._examples = first, every, examples
+        self._generator = np.random.RandomState(seed)
+        self.checks, self.max_error = 0, 0.0
+
+    def scheduled(self, step: int) -> bool:
+        return step < self._first or (self._every > 0 and step % self._every == 0)
+
+    # Return the indices of the batch examples to verify.
+    def examples(self, batch_size: int) -> slice | torch.Tensor:
+        if not self._examples or self._examples >= batch_size:
+            return slice(None)
+        return torch.from_numpy(np.sort(self._generator.choice(batch_size, self._examples, replace=False)))
+
+    def assert_close(self, computed: torch.Tensor, reference: torch.Tensor, err_msg: str) -> None:
+        computed, reference = keras.ops.convert_to_numpy(computed), keras.ops.convert_to_numpy(reference)
+        self.checks += 1
+        self.max_error = max(self.max_error, float(np.max(np.abs(computed - reference), initial=0)))
+        np.testing.assert_allclose(computed, reference, atol=1e-4, err_msg=err_msg)
+
+
+# The convolution is computed by one of the following algorithms:
+# - "im2col" extracts all input patches as a strided view, and computes the convolution
+#   by a single matrix multiplication of the patches and the reshaped kernel; in the backward
+#   pass, the gradients of the patches are summed back to the inputs with `fold`;
+# - "loop" iterates over the kernel offsets, performing one matrix multiplication for each;
+# - "fft" multiplies the Fourier transforms of the inputs and the kernel, so its cost does not
+#   grow with the kernel size; the strided convolution is subsampled from the full one;
+# - "auto" chooses between "im2col" and "fft" using an estimate of their number of operations.
+#
+# The `verify` is either a bool, or a `Verification` scheduling the verification of the layer.
 class Convolution:
     def __init__(
-        self, filters: int, kernel_size: int, stride: int, input_shape: list[int], seed: int, verify: bool,
+        self, filters: int, kernel_size: int, stride: int, input_shape: list[int], seed: int,
+        verify: bool | Verification, convolution: str = "auto",
     ) -> None:
         # Create a convolutional layer with the given arguments
         # and given input shape (e.g., [28, 28, 1]).
         self._filters = filters
         self._kernel_size = kernel_size
         self._stride = stride
-        self._verify = verify
+        self._verify = Verification() if verify is True else verify or None
+        self._convolution = convolution
+        self._forward_steps, self._backward_steps = 0, 0
 
         # Here the kernel and bias variables are created
         self._kernel = keras.Variable(keras.initializers.GlorotUniform(seed=seed)(
@@ -39,7 +86,9 @@ class Convolution:
 
         self._bias = keras.Variable(keras.initializers.Zeros()([filters]))
 
-    def forward(self, inputs: torch.Tensor) -> torch.Tensor:
+    # With `verify=False` (used when recomputing a checkpointed output), the verification is skipped
+    # and the step is not counted by the verification schedule.
+    def forward(self, inputs: torch.Tensor, verify: bool = True) -> torch.Tensor:
         # TODO: Compute the forward propagation through the convolution
         # with ReLU activation, and return the result.
         #
@@ -47,13 +96,18 @@ class Convolution:
         # manually iterate through the individual pixels, batch examples,
         # input filters, or output filters. However, you can manually
         # iterate through the kernel size.
-        output = ...
+        with torch.no_grad():
+            output = getattr(self, "_forward_{}".format(self._algorithm(inputs)))(inputs)
+
+        if not verify:
+            return output
 
         # If requested, verify that `output` contains a correct value.
-        if self._verify:
-            reference = keras.ops.relu(keras.ops.conv(inputs, self._kernel, self._stride) + self._bias)
-            np.testing.assert_allclose(keras.ops.convert_to_numpy(output), keras.ops.convert_to_numpy(reference),
-                                       atol=1e-4, err_msg="Forward pass differs!")
+        if self._verify and self._verify.scheduled(self._forward_steps):
+            examples = self._verify.examples(len(inputs))
+            reference = keras.ops.relu(keras.ops.conv(inputs[examples], self._kernel, self._stride) + self._bias)
+            self._verify.assert_close(output[examples], reference, "Forward pass differs!")
+        self._forward_steps += 1
 
         return output
 
@@ -66,34 +120,149 @@ class Convolution:
         # - the `inputs` layer,
         # - `self._kernel`,
         # - `self._bias`.
-        inputs_gradient, kernel_gradient, bias_gradient = ..., ..., ...
+        with torch.no_grad():
+            # The gradient with respect to the convolution before the ReLU activation; the reference
+            # below is given the unmasked `outputs_gradient`, so that it checks the masking too.
+            relu_gradient = outputs_gradient * (outputs > 0)
+            backward = getattr(self, "_backward_{}".format(self._algorithm(inputs)))
+            inputs_gradient, kernel_gradient = backward(inputs, relu_gradient)
+            bias_gradient = keras.ops.sum(relu_gradient, axis=[0, 1, 2])
 
         # If requested, verify that the three computed gradients are correct.
-        if self._verify:
-            inputs.requires_grad_(True)
-            inputs.grad = self._kernel.value.grad = self._bias.value.grad = None
+        if self._verify and self._verify.scheduled(self._backward_steps):
+            examples = self._verify.examples(len(inputs))
+            computed = [inputs_gradient[examples], kernel_gradient, bias_gradient]
+            if isinstance(examples, torch.Tensor):
+                # The kernel and bias gradients sum over the batch, so they are recomputed for the subset.
+                with torch.no_grad():
+                    computed[1] = backward(inputs[examples], relu_gradient[examples])[1]
+                    computed[2] = keras.ops.sum(relu_gradient[examples], axis=[0, 1, 2])
+
+            inputs = inputs[examples].detach().requires_grad_(True)
+            self._kernel.value.grad = self._bias.value.grad = None
             reference = keras.ops.relu(keras.ops.conv(inputs, self._kernel, self._stride) + self._bias)
-            reference.backward(gradient=outputs_gradient, inputs=[inputs, self._kernel.value, self._bias.value])
-            for name, computed, reference in zip(
-                    ["Inputs", "Kernel", "Bias"], [inputs_gradient, kernel_gradient, bias_gradient],
-                    [inputs.grad, self._kernel.value.grad, self._bias.value.grad]):
-                np.testing.assert_allclose(keras.ops.convert_to_numpy(computed), keras.ops.convert_to_numpy(reference),
-                                           atol=1e-4, err_msg=name + " gradient differs!")
+            reference.backward(
+                gradient=outputs_gradient[examples], inputs=[inputs, self._kernel.value, self._bias.value])
+            references = [inputs.grad, self._kernel.value.grad, self._bias.value.grad]
+            for name, computed, reference in zip(["Inputs", "Kernel", "Bias"], computed, references):
+                self._verify.assert_close(computed, reference, name + " gradient differs!")
+        self._backward_steps += 1
 
         # Return the inputs gradient, the layer variables, and their gradients.
         return inputs_gradient, [self._kernel, self._bias], [kernel_gradient, bias_gradient]
 
+    def _algorithm(self, inputs: torch.Tensor) -> str:
+        if self._convolution != "auto":
+            return self._convolution
+
+        # The direct convolution performs a multiply-add for every output, kernel position and input
+        # channel. The FFT-based one transforms the inputs and the outputs (`5 n log2 n` operations
+        # each) and multiplies the complex spectra (4 operations) for every channel pair.
+        batch, height, width, channels = inputs.shape
+        direct = batch * np.prod(self._output_size(inputs)) * self._kernel_size ** 2 * channels * self._filters
+        spectrum = height * (width // 2 + 1)
+        fft = (batch * (channels + self._filters) * 5 * height * width * np.log2(height * width)
+               + 4 * batch * channels * self._filters * spectrum)
+        return "fft" if fft < direct else "im2col"
+
+    def _output_size(self, inputs: torch.Tensor) -> tuple[int, int]:
+        return ((inputs.shape[1] - self._kernel_size) // self._stride + 1,
+                (inputs.shape[2] - self._kernel_size) // self._stride + 1)
+
+    # Return a view of all input patches with shape `[batch, height, width, kernel_size, kernel_size, channels]`.
+    def _patches(self, inputs: torch.Tensor) -> torch.Tensor:
+        inputs = inputs.contiguous()
+        batch_stride, row_stride, column_stride, channel_stride = inputs.stride()
+        return inputs.as_strided(
+            [inputs.shape[0], *self._output_size(inputs), self._kernel_size, self._kernel_size, inputs.shape[3]],
+            [batch_stride, self._stride * row_stride, self._stride * column_stride, row_stride, column_stride,
+             channel_stride])
+
+    def _forward_im2col(self, inputs: torch.Tensor) -> torch.Tensor:
+        patches = self._patches(inputs)
+        output = torch.addmm(self._bias.value, patches.reshape(-1, self._kernel.value[..., 0].numel()),
+                             self._kernel.value.reshape(-1, self._filters))
+        return output.relu_().reshape(*patches.shape[:3], self._filters)
+
+    def _backward_im2col(self, inputs: torch.Tensor, gradient: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        patches = self._patches(inputs).reshape(-1, self._kernel.value[..., 0].numel())
+        kernel_gradient = patches.T @ gradient.reshape(-1, self._filters)
+
+        # The `fold` sums the patch gradients into the inputs; it requires the channels-first layout,
+        # so the patch gradients are computed directly as `[batch, channels * kernel_size^2, height * width]`.
+        kernel = self._kernel.value.permute(2, 0, 1, 3).reshape(-1, self._filters)
+        patches_gradient = kernel @ gradient.reshape(len(gradient), -1, self._filters).mT
+        inputs_gradient = torch.nn.functional.fold(
+            patches_gradient, inputs.shape[1:3], self._kernel_size, stride=self._stride)
+        return inputs_gradient.permute(0, 2, 3, 1), kernel_gradient.reshape(self._kernel.shape)
+
+    # Both the inputs and the kernel are transformed with the spatial size of the inputs; the circular
+    # correlation then equals the valid convolution on the positions `[0, height - kernel_size]`.
+    def _forward_fft(self, inputs: torch.Tensor) -> torch.Tensor:
+        size = inputs.shape[1:3]
+        inputs_fft = torch.fft.rfft2(inputs.permute(0, 3, 1, 2), s=size)
+        kernel_fft = torch.fft.rfft2(self._kernel.value.permute(3, 2, 0, 1), s=size)
+        output = torch.fft.irfft2(torch.einsum("nchw,fchw->nfhw", inputs_fft, kernel_fft.conj()), s=size)
+        _, rows, columns = self._offset_window(inputs, 0, 0)
+        output = output[:, :, rows, columns].permute(0, 2, 3, 1) + self._bias.value
+
+        # The FFT leaves round-off errors even where the convolution is exactly zero (for example
+        # on all-zero inputs); they are flushed to zero together with the ReLU, so that the ReLU
+        # derivative in `backward` is zero on such positions, as in the direct convolution.
+        return output.masked_fill_(output <= 16 * torch.finfo(output.dtype).eps * output.abs().amax(), 0)
+
+    def _backward_fft(self, inputs: torch.Tensor, gradient: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        # The gradient with respect to the full convolution, which is zero on the unused positions.
+        size, (_, rows, columns) = inputs.shape[1:3], self._offset_window(inputs, 0, 0)
+        gradient_full = torch.zeros(len(inputs), self._filters, *size)
+        gradient_full[:, :, rows, columns] = gradient.permute(0, 3, 1, 2)
+
+        inputs_fft = torch.fft.rfft2(inputs.permute(0, 3, 1, 2), s=size)
+        gradient_fft = torch.fft.rfft2(gradient_full, s=size)
+        kernel_fft = torch.fft.rfft2(self._kernel.value.permute(3, 2, 0, 1), s=size)
+        kernel_gradient = torch.fft.irfft2(
+            torch.einsum("nchw,nfhw->fchw", inputs_fft, gradient_fft.conj()), s=size)
+        inputs_gradient = torch.fft.irfft2(torch.einsum("nfhw,fchw->nchw", gradient_fft, kernel_fft), s=size)
+        return (inputs_gradient.permute(0, 2, 3, 1),
+                kernel_gradient[:, :, :self._kernel_size, :self._kernel_size].permute(2, 3, 1, 0))
+
+    # The input rows and columns used by the kernel offset `[i, j]`.
+    def _offset_window(self, inputs: torch.Tensor, i: int, j: int) -> tuple[slice, slice, slice]:
+        height, width = self._output_size(inputs)
+        return (slice(None), slice(i, i + self._stride * (height - 1) + 1, self._stride),
+                slice(j, j + self._stride * (width - 1) + 1, self._stride))
+
+    def _forward_loop(self, inputs: torch.Tensor) -> torch.Tensor:
+        output = self._bias.value.repeat(inputs.shape[0], *self._output_size(inputs), 1)
+        for i in range(self._kernel_size):
+            for j in range(self._kernel_size):
+                output += inputs[self._offset_window(inputs, i, j)] @ self._kernel.value[i, j]
+        return output.relu_()
+
+    def _backward_loop(self, inputs: torch.Tensor, gradient: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        inputs_gradient = torch.zeros_like(inputs)
+        kernel_gradient = torch.empty_like(self._kernel.value)
+        for i in range(self._kernel_size):
+            for j in range(self._kernel_size):
+                window = self._offset_window(inputs, i, j)
+                kernel_gradient[i, j] = torch.tensordot(inputs[window], gradient, dims=([0, 1, 2], [0, 1, 2]))
+                inputs_gradient[window] += gradient @ self._kernel.value[i, j].T
+        return inputs_gradient, kernel_gradient
+
 
 class Model:
     def __init__(self, args: argparse.Namespace) -> None:
         self._args = args
 
-        # Create the convolutional layers according to `args.cnn`.
+        # Create the convolutional layers according to `args.cnn`, sharing a verification schedule.
+        self.verification = args.verify and Verification(
+            args.verify_first, args.verify_every, args.verify_examples, args.seed)
         input_shape = [MNIST.H, MNIST.W, MNIST.C]
         self._convs = []
         for layer in args.cnn.split(","):
             filters, kernel_size, stride = map(int, layer.split("-"))
-            self._convs.append(Convolution(filters, kernel_size, stride, input_shape, args.seed, args.verify))
+            self._convs.append(Convolution(
+                filters, kernel_size, stride, input_shape, args.seed, self.verification, args.convolution))
             input_shape = [(input_shape[0] - kernel_size) // stride + 1,
                            (input_shape[1] - kernel_size) // stride + 1, filters]
 
@@ -106,15 +275,21 @@ class Model:
         self._accuracy = keras.metrics.SparseCategoricalAccuracy()
         self._optimizer = keras.optimizers.Adam(args.learning_rate)
 
+    # With `args.checkpoint_every=k`, the forward pass keeps only the outputs of every k-th convolution
+    # (and of the last one), and the backward pass recomputes the remaining ones segment by segment.
+    # The largest size of the kept and recomputed activations is stored in `peak_activations`.
     def train_epoch(self, dataset: MNIST.Dataset) -> None:
+        every = self._args.checkpoint_every or 1
+        self.peak_activations = 0
         for batch in dataset.batches(self._args.batch_size):
             # Forward pass through the convolutions
             hidden = keras.ops.convert_to_tensor(batch["images"])
             hidden = self._rescaling(hidden)
             conv_values = [hidden]
-            for conv in self._convs:
+            for i, conv in enumerate(self._convs, 1):
                 hidden = conv.forward(hidden)
-                conv_values.append(hidden)
+                conv_values.append(hidden if i % every == 0 or i == len(self._convs) else None)
+            kept_activations = sum(value.nbytes for value in conv_values if value is not None)
 
             # Run the classification head
             hidden_flat = self._flatten(hidden)
@@ -126,11 +301,22 @@ class Model:
             gradients = [keras.ops.sum(d_logits, axis=0), keras.ops.transpose(hidden_flat) @ d_logits]
             hidden_gradient = keras.ops.reshape(d_logits @ keras.ops.transpose(self._classifier.kernel), hidden.shape)
 
-            # Backpropagate the gradient through the convolutions
-            for conv, inputs, outputs in reversed(list(zip(self._convs, conv_values[:-1], conv_values[1:]))):
-                hidden_gradient, conv_variables, conv_gradients = conv.backward(inputs, outputs, hidden_gradient)
-                variables.extend(conv_variables)
-                gradients.extend(conv_gradients)
+            # Backpropagate the gradient through the convolutions, recomputing the missing outputs
+            # of every segment of convolutions between two kept outputs.
+            for start in reversed(range(0, len(self._convs), every)):
+                end = min(start + every, len(self._convs))
+                segment_values = [conv_values[start]]
+                for conv in self._convs[start:end - 1]:
+                    segment_values.append(conv.forward(segment_values[-1], verify=False))
+                self.peak_activations = max(self.peak_activations, kept_activations + sum(
+                    value.nbytes for value in segment_values[1:]))
+                segment_values.append(conv_values[end])
+
+                for conv, inputs, outputs in reversed(list(zip(
+                        self._convs[start:end], segment_values[:-1], segment_values[1:]))):
+                    hidden_gradient, conv_variables, conv_gradients = conv.backward(inputs, outputs, hidden_gradient)
+                    variables.extend(conv_variables)
+                    gradients.extend(conv_gradients)
 
             # Update the weights
             self._optimizer.apply(gradients, variables)
@@ -148,6 +334,58 @@ class Model:
         return self._accuracy.result()
 
 
+# Return the average duration in milliseconds of the forward and backward pass of the given
+# convolution using the given algorithm, or `keras.ops.conv` with automatic differentiation.
+def time_convolution(conv: Convolution, inputs: torch.Tensor, convolution: str, repeats: int = 20) -> float:
+    def step() -> None:
+        if convolution == "keras":
+            variables = [inputs.detach().requires_grad_(), conv._kernel.value, conv._bias.value]
+            outputs = keras.ops.relu(keras.ops.conv(variables[0], conv._kernel, conv._stride) + conv._bias)
+            outputs.backward(torch.ones_like(outputs), inputs=variables)
+        else:
+            conv._convolution = convolution
+            outputs = conv.forward(inputs)
+            conv.backward(inputs, outputs, torch.ones_like(outputs))
+
+    original_convolution = conv._convolution
+    step()  # Warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    conv._convolution = original_convolution
+    return 1000 * (time.perf_counter() - start) / repeats
+
+
+# Measure the duration of the forward and backward pass of every convolution in `args.cnn`,
+# for all our algorithms and for `keras.ops.conv` with automatic differentiation.
+def benchmark(args: argparse.Namespace) -> None:
+    input_shape = [MNIST.H, MNIST.W, MNIST.C]
+    for layer in args.cnn.split(","):
+        filters, kernel_size, stride = map(int, layer.split("-"))
+        inputs = keras.random.uniform([args.batch_size, *input_shape], seed=args.seed)
+        conv = Convolution(filters, kernel_size, stride, input_shape, args.seed, False)
+        print("Convolution {} of {}x{}x{} inputs (auto chooses {}): {}".format(
+            layer, *input_shape, conv._algorithm(inputs), ", ".join("{} {:.2f}ms".format(
+                convolution, time_convolution(conv, inputs, convolution))
+                for convolution in ["im2col", "loop", "fft", "keras"])), flush=True)
+
+        input_shape = [(input_shape[0] - kernel_size) // stride + 1,
+                       (input_shape[1] - kernel_size) // stride + 1, filters]
+
+
+# Compare the direct and the FFT-based convolution with increasing kernel sizes, on inputs
+# of the size of the MNIST images with the number of channels given by the first `args.cnn` layer.
+def benchmark_fft(args: argparse.Namespace) -> None:
+    channels = int(args.cnn.split(",")[0].split("-")[0])
+    inputs = keras.random.uniform([args.batch_size, MNIST.H, MNIST.W, channels], seed=args.seed)
+    for kernel_size in range(3, MNIST.H + 1, 2):
+        conv = Convolution(channels, kernel_size, 1, inputs.shape[1:], args.seed, False)
+        im2col, fft = time_convolution(conv, inputs, "im2col"), time_convolution(conv, inputs, "fft")
+        print("Kernel {}x{}: im2col {:.2f}ms, fft {:.2f}ms, faster {}, auto chooses {}".format(
+            kernel_size, kernel_size, im2col, fft, "im2col" if im2col < fft else "fft", conv._algorithm(inputs)),
+            flush=True)
+
+
 def main(args: argparse.Namespace) -> float:
     # Set the random seed and the number of threads.
     keras.utils.set_random_seed(args.seed)
@@ -155,6 +393,10 @@ def main(args: argparse.Namespace) -> float:
         torch.set_num_threads(args.threads)
         torch.set_num_interop_threads(args.threads)
 
+    if args.benchmark or args.benchmark_fft:
+        with keras.device("cpu"):
+            return benchmark(args) if args.benchmark else benchmark_fft(args)
+
     # Load data, using only 5 000 training images
     mnist = MNIST(size={"train": 5_000})
 
@@ -164,7 +406,11 @@ def main(args: argparse.Namespace) -> float:
         model = Model(args)
 
         for epoch in range(args.epochs):
+            start = time.perf_counter()
             model.train_epoch(mnist.train)
+            if args.checkpoint_every:
+                print("Epoch {} took {:.2f}s, with at most {:.2f}MB of activations stored".format(
+                    epoch + 1, time.perf_counter() - start, model.peak_activations / 1024 ** 2))
 
             dev_accuracy = model.evaluate(mnist.dev)
             print("Dev accuracy after epoch {} is {:.2f}".format(epoch + 1, 100 * dev_accuracy))
@@ -172,6 +418,10 @@ def main(args: argparse.Namespace) -> float:
         test_accuracy = model.evaluate(mnist.test)
         print("Test accuracy after epoch {} is {:.2f}".format(epoch + 1, 100 * test_accuracy))
 
+        if model.verification:
+            print("Verified {} times, the maximum error was {:.3g}".format(
+                model.verification.checks, model.verification.max_error))
+
     # Return dev and test accuracies for ReCodEx to validate.
     return dev_accuracy, test_accuracy
 
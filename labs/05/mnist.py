@@ -1,9 +1,18 @@
+import contextlib
+import hashlib
+import itertools
+import json
+from multiprocessing import resource_tracker, shared_memory
 import os
 import sys
-from typing import Iterator
+import tempfile
+from typing import Any, Iterator
 import urllib.request
+import warnings
+import zipfile
 
 import numpy as np
+import torch
 
 
 class MNIST:
@@ -15,47 +24,265 @@ class MNIST:
     _URL: str = "https://ufal.mff.cuni.cz/~straka/courses/npfl138/2324/datasets/"
 
     class Dataset:
-        def __init__(self, data: dict[str, np.ndarray], shuffle_batches: bool, seed: int = 42) -> None:
+        def __init__(
+            self, data: dict[str, np.ndarray], shuffle_batches: bool, seed: int = 42, as_tensors: bool = False,
+        ) -> None:
             self._data = data
             self._size = len(self._data["images"])
 
-            self._shuffler = np.random.RandomState(seed) if shuffle_batches else None
+            if as_tensors:
+                # Keep the data as contiguous PyTorch tensors and shuffle them with a PyTorch
+                # generator, so that the batches are produced without any NumPy-to-PyTorch conversion.
+                with warnings.catch_warnings():  # The read-only arrays shared across processes are never written.
+                    warnings.filterwarnings("ignore", "The given NumPy array is not writable")
+                    self._data = {key: torch.from_numpy(np.ascontiguousarray(value)) for key, value in data.items()}
+                self._shuffler = torch.Generator().manual_seed(seed) if shuffle_batches else None
+            else:
+                self._shuffler = np.random.RandomState(seed) if shuffle_batches else None
+
+            # The position of the batch iterator; the generator state is the one used for the current epoch.
+            self._epoch, self._position, self._resume = 0, 0, False
+            self._epoch_rng_state = self._get_rng_state()
 
         @property
-        def data(self) -> dict[str, np.ndarray]:
+        def data(self) -> dict[str, np.ndarray | torch.Tensor]:
             return self._data
 
         @property
         def size(self) -> int:
             return self._size
 
-        def batches(self, size: int | None = None) -> Iterator[dict[str, np.ndarray]]:
-            permutation = self._shuffler.permutation(self._size) if self._shuffler else np.arange(self._size)
+        # With `last_batch="keep"`, the last batch of an epoch may be smaller. To keep all batches
+        # of the same shape (for example for `torch.compile`d steps), `last_batch="pad"` pads the last
+        # batch by repeating its last example and adds a boolean "mask" of valid examples to every
+        # batch, and `last_batch="drop"` drops the incomplete last batch.
+        def batches(
+            self, size: int | None = None, last_batch: str = "keep",
+        ) -> Iterator[dict[str, np.ndarray | torch.Tensor]]:
+            if last_batch not in ["keep", "pad", "drop"]:
+                raise ValueError("Unknown last_batch mode '{}'.".format(last_batch))
+            if last_batch != "keep" and not size:
+                raise ValueError("The last_batch mode '{}' requires a batch size.".format(last_batch))
+
+            if not self._resume:
+                if self._position:  # The previous iteration stopped in the middle of an epoch.
+                    self._epoch += 1
+                self._position, self._epoch_rng_state = 0, self._get_rng_state()
+            self._resume = False
+
+            while True:
+                permutation = self._permutation()
+                if last_batch == "drop":
+                    permutation = permutation[:len(permutation) - len(permutation) % size]
+                if not self._position or self._position < len(permutation):
+                    break
+                # A state saved after the last batch of an epoch resumes with the next epoch.
+                self._epoch, self._position, self._epoch_rng_state = self._epoch + 1, 0, self._get_rng_state()
+            permutation = permutation[self._position:]
             while len(permutation):
                 batch_size = min(size or np.inf, len(permutation))
                 batch_perm = permutation[:batch_size]
                 permutation = permutation[batch_size:]
 
+                if last_batch == "pad":
+                    positions = torch.arange(size) if isinstance(batch_perm, torch.Tensor) else np.arange(size)
+                    batch_perm, mask = batch_perm[positions.clip(max=batch_size - 1)], positions < batch_size
+
                 batch = {}
                 for key in self._data:
                     batch[key] = self._data[key][batch_perm]
+                if last_batch == "pad":
+                    batch["mask"] = mask
+                self._position += batch_size
                 yield batch
 
+            self._epoch, self._position, self._epoch_rng_state = self._epoch + 1, 0, self._get_rng_state()
+
+        # The checkpointable state of the batch iterator: the current epoch, the number of examples
+        # of the epoch already returned, and the generator state used to shuffle the current epoch.
+        def get_state(self) -> dict[str, Any]:
+            return {"epoch": self._epoch, "position": self._position, "rng_state": self._epoch_rng_state}
+
+        # Restore a state returned by `get_state`; the next `batches` call then resumes from it.
+        def set_state(self, state: dict[str, Any]) -> None:
+            self._epoch, self._position, self._epoch_rng_state = state["epoch"], state["position"], state["rng_state"]
+            if self._shuffler is not None:
+                self._shuffler.set_state(self._epoch_rng_state)
+            self._resume = True
+
+        def _get_rng_state(self) -> Any:
+            return self._shuffler.get_state() if self._shuffler is not None else None
+
+        def _permutation(self) -> np.ndarray | torch.Tensor:
+            if isinstance(self._shuffler, torch.Generator):
+                return torch.randperm(self._size, generator=self._shuffler)
+            if isinstance(self._data["images"], torch.Tensor):
+                return torch.arange(self._size)
+            return self._shuffler.permutation(self._size) if self._shuffler else np.arange(self._size)
+
     Datasplit = Dataset  # Kept for backward compatibility
 
-    def __init__(self, dataset: str = "mnist", size: dict[str, int] = {}) -> None:
+    def __init__(
+        self, dataset: str = "mnist", size: dict[str, int] = {}, as_tensors: bool = False, shared: bool = False,
+    ) -> None:
         path = "{}.npz".format(dataset)
         if not os.path.exists(path):
             print("Downloading dataset {}...".format(dataset), file=sys.stderr)
             urllib.request.urlretrieve("{}/{}".format(self._URL, path), filename="{}.tmp".format(path))
             os.rename("{}.tmp".format(path), path)
 
-        mnist = np.load(path)
+        mnist = self._load_shared(path, size) if shared else self._load(path, size)
         for dataset in ["train", "dev", "test"]:
-            data = {key[len(dataset) + 1:]: mnist[key][:size.get(dataset, None)]
-                    for key in mnist if key.startswith(dataset)}
-            setattr(self, dataset, self.Dataset(data, shuffle_batches=dataset == "train"))
+            data = {key[len(dataset) + 1:]: mnist[key] for key in mnist if key.startswith(dataset)}
+            setattr(self, dataset, self.Dataset(data, shuffle_batches=dataset == "train", as_tensors=as_tensors))
 
     train: Dataset
     dev: Dataset
     test: Dataset
+
+    # Load the arrays of the given `.npz` file. When `size` limits a dataset, only the leading
+    # rows of its arrays are read (and decompressed), instead of loading the arrays in full.
+    @staticmethod
+    def _load(path: str, size: dict[str, int]) -> dict[str, np.ndarray]:
+        arrays = {}
+        with zipfile.ZipFile(path, "r") as npz_file:
+            for name in npz_file.namelist():
+                key, rows = name.removesuffix(".npy"), size.get(name.split("_", 1)[0], None)
+                with npz_file.open(name, "r") as npy_file:
+                    version = np.lib.format.read_magic(npy_file)
+                    if rows is not None and version in [(1, 0), (2, 0)]:
+                        read_header = getattr(np.lib.format, "read_array_header_{}_{}".format(*version))
+                        shape, fortran_order, dtype = read_header(npy_file)
+                        if shape and not fortran_order and not dtype.hasobject:
+                            array = np.empty([min(rows, shape[0]), *shape[1:]], dtype)
+                            if array.size and npy_file.readinto(memoryview(array).cast("B")) != array.nbytes:
+                                raise RuntimeError("The array {} in {} is truncated.".format(key, path))
+                            arrays[key] = array
+                            continue
+                with npz_file.open(name, "r") as npy_file:
+                    arrays[key] = np.lib.format.read_array(npy_file)[:rows]
+        return arrays
+
+    # Segments of the datasets in shared memory, which were attached by this process.
+    _shared_segments: dict[str, list[shared_memory.SharedMemory]] = {}
+
+    # Load the arrays through a cross-process registry in shared memory. The first process
+    # publishes the arrays as named shared-memory segments, and all later loads of the same
+    # file and `size` (in this or any other process) attach to them read-only without copying.
+    # The segments outlive the processes using them; use `unlink_shared` to remove them.
+    #
+    # Publishing is serialized by `_shared_lock`, which the operating system releases even when its
+    # holder is killed. A process unable to attach waits for the lock and tries attaching again, so
+    # concurrent loads publish the arrays only once; if there is still no complete manifest, no other
+    # process is publishing, so any existing segments were left by a killed publisher and are replaced.
+    @staticmethod
+    def _load_shared(path: str, size: dict[str, int]) -> dict[str, np.ndarray]:
+        name = MNIST._shared_name(path, size)
+        try:
+            return MNIST._attach_shared(name)
+        except (FileNotFoundError, ValueError):  # Not published yet, or the manifest is being written.
+            pass
+
+        with MNIST._shared_lock(name):
+            try:
+                return MNIST._attach_shared(name)
+            except (FileNotFoundError, ValueError):
+                pass
+            arrays = MNIST._load(path, size)
+            MNIST._unlink_shared_segments(name)
+            MNIST._publish_shared(name, arrays)
+            return MNIST._attach_shared(name)
+
+    # Hold an exclusive lock of the file `{name}.lock` in the temporary directory; the file is kept,
+    # because removing it could let two processes lock different files of the same name.
+    @staticmethod
+    @contextlib.contextmanager
+    def _shared_lock(name: str) -> Iterator[None]:
+        with open(os.path.join(tempfile.gettempdir(), "{}.lock".format(name)), "a+b") as lock_file:
+            if os.name == "nt":
+                import msvcrt
+                while True:
+                    try:
+                        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)  # Retries for 10s, then raises.
+                        break
+                    except OSError:
+                        pass
+            else:
+                import fcntl
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield  # The lock is released by closing the file.
+
+    @staticmethod
+    def _shared_name(path: str, size: dict[str, int]) -> str:
+        key = repr((os.path.abspath(path), os.path.getmtime(path), sorted(size.items())))
+        return "npfl138_{}".format(hashlib.sha1(key.encode()).hexdigest()[:16])
+
+    @staticmethod
+    def _shared_segment(name: str, size: int = 0) -> shared_memory.SharedMemory:
+        segment = shared_memory.SharedMemory(name, create=size > 0, size=size)
+        # Otherwise the resource tracker would unlink the segment when this process exits.
+        resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+    @staticmethod
+    def _unlink_segment(segment: shared_memory.SharedMemory) -> None:
+        resource_tracker.register(segment._name, "shared_memory")  # Balances the unregistration in `unlink`.
+        segment.unlink()
+
+    # The array segments are named `{name}_{i}`; the manifest segment `{name}` describing them
+    # is created only after all arrays are copied, and is complete once it is valid JSON.
+    @staticmethod
+    def _publish_shared(name: str, arrays: dict[str, np.ndarray]) -> None:
+        segments, manifest = [], []
+        try:
+            for i, (key, array) in enumerate(arrays.items()):
+                segments.append(MNIST._shared_segment("{}_{}".format(name, i), max(array.nbytes, 1)))
+                np.ndarray(array.shape, array.dtype, buffer=segments[-1].buf)[...] = array
+                manifest.append([key, array.dtype.str, array.shape])
+            manifest = json.dumps(manifest).encode()
+            segments.append(MNIST._shared_segment(name, len(manifest)))
+            segments[-1].buf[:len(manifest)] = manifest
+        except BaseException:
+            for segment in segments:
+                MNIST._unlink_segment(segment)
+            raise
+        finally:
+            for segment in segments:
+                segment.close()
+
+    @staticmethod
+    def _attach_shared(name: str) -> dict[str, np.ndarray]:
+        segments = MNIST._shared_segments.get(name) or [MNIST._shared_segment(name)]
+        try:
+            manifest = json.loads(bytes(segments[0].buf).rstrip(b"\0"))
+        except ValueError:
+            segments[0].close()
+            raise
+        if name not in MNIST._shared_segments:
+            segments += [MNIST._shared_segment("{}_{}".format(name, i)) for i in range(len(manifest))]
+            MNIST._shared_segments[name] = segments
+
+        arrays = {}
+        for (key, dtype, shape), segment in zip(manifest, segments[1:]):
+            arrays[key] = np.ndarray(shape, dtype, buffer=segment.buf)
+            arrays[key].flags.writeable = False
+        return arrays
+
+    # Remove the shared-memory segments published by `MNIST(..., shared=True)` with the same arguments.
+    # Processes which already attached to them keep their data until they exit.
+    @staticmethod
+    def unlink_shared(dataset: str = "mnist", size: dict[str, int] = {}) -> None:
+        name = MNIST._shared_name("{}.npz".format(dataset), size)
+        MNIST._unlink_shared_segments(name)
+
+    @staticmethod
+    def _unlink_shared_segments(name: str) -> None:
+        for i in itertools.count():
+            try:
+                MNIST._unlink_segment(MNIST._shared_segment("{}_{}".format(name, i)))
+            except FileNotFoundError:
+                break
+        try:
+            MNIST._unlink_segment(MNIST._shared_segment(name))
+        except FileNotFoundError:
+            pass